@@ -20,27 +20,26 @@
 # In[2]:
 
 
-import ee
-import geemap
 import json
 import os
-import requests
 from datetime import datetime
-from geemap import geojson_to_ee, ee_to_geojson
 import geopandas as gpd 
 import pandas as pd
 import pickle
 import math
-#ee.Authenticate()
-ee.Initialize()
+from pointStore import dateFrames, writePointStore, writePointAttributes, readPointStore, \
+    readPointValues, appendPointValues, pointSetHash, cachedStaticValues
+from localRaster import findScenes, sceneMetadata, extractSceneValues, extractStaticValues
+from eeCache import useCache, getInfo, cacheStats
+from runConfig import commandLineConfig, applyConfig
 
 
 # In[3]:
 
 
 ### Enter start and end date as numbers for year, month, day ###
-startDate = ee.Date.fromYMD(2021, 1, 1)
-endDate = ee.Date.fromYMD(2021, 12, 31)
+startDate = datetime(2021, 1, 1)
+endDate = datetime(2021, 12, 31)
 # Enter the seasonal portion for each year in the date range to process
 startMonth = 1  
 endMonth = 12
@@ -56,6 +55,27 @@ NIR_DARK_THRESHOLD = 0.15
 CLOUD_PROJECTED_DISTANCE = 1
 BUFFER = 50
 
+# Set to True to calculate the percentage of points covered by clouds for all images on the 
+# server and only extract the images where that percentage is less than max_cloud_percent. 
+# This is the same test used in the "StockSOC_ProcessPoints" script.
+cloudPrescreen = True
+max_cloud_percent = 0.2
+
+# Extraction mode: 'collection' samples all of the images in a few server-side requests, 
+# 'concurrent' extracts one image per request using several requests at the same time and
+# 'perDate' extracts the points one image at a time
+extractionMode = 'collection'
+
+# Maximum number of simultaneous requests and retries for failed requests in 'concurrent' mode
+maxWorkers = 8
+maxRetries = 5
+
+# Set to True to only extract images that are not already in the point store (outStore). The 
+# store is saved after each batch of checkpointBatch images so an interrupted run can be 
+# restarted. Use a new store if the boundary, points or cloud masking parameters are changed.
+incremental = False
+checkpointBatch = 20
+
 
 # In[4]:
 
@@ -64,6 +84,23 @@ BUFFER = 50
 boundaryShp = ""
 inPoints = ""
 outPickle = ""
+# Directory for the point data in columnar (Parquet) format. Leave empty to only output the pickle file.
+outStore = ""
+
+# Directory to save Earth Engine results so they don't need to be requested again when the
+# script is run with the same settings. Leave empty to turn off the cache.
+cacheDir = ""
+
+# Source of the image data: 'gee' to use Google Earth Engine or 'local' to extract the points
+# from Sentinel-2 scenes and TWI and CHILI images saved as GeoTIFF files on a local disk
+backend = 'gee'
+# Pattern for the local Sentinel-2 scene files, with the date in each file name, and a list of 
+# the band names in the scene files (None to use the band descriptions in the files)
+localScenes = ""
+localBandNames = None
+# Local TWI and CHILI images
+localTWI = ""
+localCHILI = ""
 
 
 # In[ ]:
@@ -76,6 +113,41 @@ BD = 'BD'   # Attribute name for bulk density
 depth = 15    # Soil sample depth in cm
 
 
+# In[ ]:
+
+
+# Headless (batch) mode: to run the script without a notebook enter the name of a JSON file
+# with the parameters to use on the command line, e.g. "python StockSOC_ExtractPoints.py config.json". 
+# Parameters in the file replace the values entered above and no maps are created.
+configFile = commandLineConfig()
+if (configFile):
+    applyConfig(configFile, globals())
+showMap = not configFile
+
+
+# In[ ]:
+
+
+# Import and initialize Earth Engine. This is not needed when the points are extracted from
+# local files so the local backend runs without the Earth Engine API and geemap installed.
+if (backend == 'gee'):
+    import ee
+    import geemap
+    import requests
+    from geemap import geojson_to_ee, ee_to_geojson
+    from eeExtraction import addPointID, getCollectionMetadata, extractCollectionValues, \
+        extractDatesConcurrently, extractNewImages, extractStaticImageValues, pointCloudFractions, \
+        subsetMetadata
+    #ee.Authenticate()
+    ee.Initialize()
+# Save the results of Earth Engine requests in cacheDir so identical requests are only sent once
+if (cacheDir):
+    useCache(cacheDir)
+
+
+# In[ ]:
+
+
 # In[5]:
 
 
@@ -188,7 +260,7 @@ def apply_cld_shdw_mask(img):
 
 # Function make the server-side feature collection accessible to the client
 def getValues(fc):
-    features = fc.getInfo()['features']
+    features = getInfo(fc)['features']
     dictarr = []
     for f in features:
         attr = f['properties']
@@ -199,32 +271,36 @@ def getValues(fc):
 # In[11]:
 
 
-# Convert input boundary Shapefile to a GEE boundary feature to constrain spatial extent
-boundary_ee = geemap.shp_to_ee(boundaryShp)
+if (backend == 'gee'):
+    # Convert input boundary Shapefile to a GEE boundary feature to constrain spatial extent
+    boundary_ee = geemap.shp_to_ee(boundaryShp)
 
 
 # In[12]:
 
 
-# Get image data using temporal and spatial constraints
-s2_sr_cld_col = get_s2_sr_cld_col(boundary_ee, startDate, endDate)
+if (backend == 'gee'):
+    # Get image data using temporal and spatial constraints
+    s2_sr_cld_col = get_s2_sr_cld_col(boundary_ee, startDate, endDate)
 
 
 # In[13]:
 
 
-# Apply cloud/shadow mask
-sentinelCollection = (s2_sr_cld_col.map(add_cld_shdw_mask)
-                             .map(apply_cld_shdw_mask))
+if (backend == 'gee'):
+    # Apply cloud/shadow mask
+    sentinelCollection = (s2_sr_cld_col.map(add_cld_shdw_mask)
+                                 .map(apply_cld_shdw_mask))
 
 
 # In[14]:
 
 
-# Create a list of dates for all images in the collection
-datesObject = sentinelCollection.aggregate_array("system:time_start")
-dateList =  datesObject.getInfo()
-dateList = [datetime.utcfromtimestamp(x / 1000).strftime('%Y_%m_%d') for x in dateList]
+if (backend == 'gee'):
+    # Get the number of images and a list of dates for all images in the collection with one request
+    collectionMetadata = getCollectionMetadata(sentinelCollection, endDate)
+    numImages = collectionMetadata['size']
+    dateList = collectionMetadata['dates']
 
 
 # In[15]:
@@ -241,8 +317,24 @@ sentinel_vis = {
 # In[16]:
 
 
-# Convert input sample points Shapefile to a GEE feature
-sample_locations = geemap.shp_to_ee(inPoints)
+if (backend == 'gee'):
+    # Convert input sample points Shapefile to a GEE feature and add a point identifier
+    sample_locations = addPointID(geemap.shp_to_ee(inPoints))
+
+
+# In[ ]:
+
+
+# Remove images where too many of the points are covered by clouds before extracting the points
+if (backend == 'gee' and cloudPrescreen):
+    cloudFractions = pointCloudFractions(sentinelCollection, sample_locations, pixScale, 
+                                         getInfo(sample_locations.size()))
+    clearIDs = [i for i in collectionMetadata['imageIDs'] if cloudFractions.get(i, 1) < max_cloud_percent]
+    print(str(len(clearIDs)) + " of " + str(numImages) + " images passed the cloud pre-screen")
+    sentinelCollection = sentinelCollection.filter(ee.Filter.inList('system:index', clearIDs))
+    collectionMetadata = subsetMetadata(collectionMetadata, clearIDs)
+    numImages = collectionMetadata['size']
+    dateList = collectionMetadata['dates']
 
 
 # In[17]:
@@ -255,60 +347,139 @@ extractedValues = {}
 # In[18]:
 
 
-# Calculate Topographic wetness index and extract points
-upslopeArea = (ee.Image("MERIT/Hydro/v1_0_1")
-    .select('upa'))
-elv = (ee.Image("MERIT/Hydro/v1_0_1")
-    .select('elv'))
+if (backend == 'gee'):
+    # Calculate Topographic wetness index
+    upslopeArea = (ee.Image("MERIT/Hydro/v1_0_1")
+        .select('upa'))
+    elv = (ee.Image("MERIT/Hydro/v1_0_1")
+        .select('elv'))
 
-slope = ee.Terrain.slope(elv)
-upslopeArea = upslopeArea.multiply(1000000).rename('UpslopeArea')
-slopeRad = slope.divide(180).multiply(math.pi)
-TWI = ee.Image.log(upslopeArea.divide(slopeRad.tan())).rename('TWI')
-extractedPointsTWI = geemap.extract_values_to_points(sample_locations, TWI, scale=pixScale)
-dictarrTWI = getValues(extractedPointsTWI)
+    slope = ee.Terrain.slope(elv)
+    upslopeArea = upslopeArea.multiply(1000000).rename('UpslopeArea')
+    slopeRad = slope.divide(180).multiply(math.pi)
+    TWI = ee.Image.log(upslopeArea.divide(slopeRad.tan())).rename('TWI')
 
 
 # In[19]:
 
 
-# Read in and extract points for continuous heat-insolation load index and extract points
-chili = (ee.Image("CSP/ERGo/1_0/Global/SRTM_CHILI"))
-extractedPointsCHILI = geemap.extract_values_to_points(sample_locations, chili, scale=pixScale)
-dictarrCHILI = getValues(extractedPointsCHILI)
+if (backend == 'gee'):
+    # Read in continuous heat-insolation load index
+    chili = (ee.Image("CSP/ERGo/1_0/Global/SRTM_CHILI"))
+
+
+# In[ ]:
+
+
+# Extract TWI and CHILI for the sample points. The values are saved in cacheDir and reused
+# when the script is run again with the same points and pixel scale.
+if (backend == 'gee'):
+    staticValues = cachedStaticValues(cacheDir, ['gee', sample_locations.serialize(), pixScale], 
+        lambda: extractStaticImageValues(sample_locations, {'twi': TWI, 'chili': chili}, pixScale))
 
 
 # In[20]:
 
 
-# Create a list of the images for processing
-images = sentinelCollection.toList(sentinelCollection.size())
+if (backend == 'gee'):
+    # Create a list of the images for processing
+    images = sentinelCollection.toList(numImages)
+
+
+# In[21]:
+
+
+# Read the sample points, the list of scenes and the TWI and CHILI values from local files
+if (backend == 'local'):
+    localPoints = gpd.read_file(inPoints)
+    localPoints['pointID'] = localPoints.index.astype(str)
+    scenes = findScenes(localScenes, startDate, endDate, startMonth, endMonth)
+    collectionMetadata = sceneMetadata(scenes)
+    numImages = collectionMetadata['size']
+    dateList = collectionMetadata['dates']
+    staticValues = cachedStaticValues(cacheDir, ['local', pointSetHash(localPoints), localTWI, localCHILI], 
+        lambda: extractStaticValues(localPoints, {'twi': localTWI, 'chili': localCHILI}))
 
 
 # In[21]:
 
 
-Map=geemap.Map()
-Map.centerObject(boundary_ee, 13)
-for index in range(0, sentinelCollection.size().getInfo()-1):
-    print("Processing " + dateList[index] + ": " + str(sentinelCollection.size().getInfo()-1 - index - 1) + " images to go      ", end = "\r")
-    image = ee.Image(images.get(index))
-    extractedPoints = geemap.extract_values_to_points(sample_locations, image, scale=pixScale)
-    dictarr = getValues(extractedPoints)
-    points = gpd.GeoDataFrame(dictarr)
-    # Add the following variables to the collection of point data
+# Function to add stock, TWI and CHILI to the point data for one date. TWI and CHILI are
+# joined using the point ID so the values always match the right point.
+def addPointVariables(points):
     points['stock'] = points[BD] * points[SOC] * depth
-    points['twi'] = gpd.GeoDataFrame(dictarrTWI)['first']
-    points['chili'] = gpd.GeoDataFrame(dictarrCHILI)['first']
-    
-    # Use band 3 to select only points not covered by clouds
-    if ('B3' in points):  
-        extractedValues.update({dateList[index] : points})
-    # Add the image layer for display
-    Map.addLayer(image, sentinel_vis, dateList[index])
+    return points.merge(staticValues, on='pointID', how='left')
+
+
+# In[ ]:
+
+
+Map = None
+if (backend == 'gee' and showMap):
+    Map=geemap.Map()
+    Map.centerObject(boundary_ee, 13)
+
+if (backend == 'local'):
+    # Read the points from the local scenes, skipping scenes already in the store in incremental mode
+    storedIDs = set()
+    if (incremental):
+        storedIDs = set(readPointValues(outStore, columns=[])['imageID'])
+    pointValues = extractSceneValues(localPoints, scenes, localBandNames, skipIDs=storedIDs)
+    pointAttributes = pd.DataFrame(localPoints.drop(columns='geometry'))
+    if (incremental):
+        writePointAttributes(outStore, addPointVariables(pointAttributes))
+        if (len(pointValues.index) > 0):
+            appendPointValues(outStore, pointValues)
+        extractedValues = readPointStore(outStore)
+    else:
+        for date, points in dateFrames(pointValues, pointAttributes).items():
+            extractedValues.update({date : addPointVariables(points)})
+elif (incremental):
+    # Update the point attributes and only extract the images that aren't in the store yet
+    writePointAttributes(outStore, addPointVariables(pd.DataFrame(getValues(sample_locations))))
+    newImages = extractNewImages(sentinelCollection, collectionMetadata, sample_locations, pixScale, 
+                                 getInfo(sample_locations.size()), outStore, checkpointBatch)
+    print("\nAdded " + str(len(newImages)) + " new images to " + outStore)
+    extractedValues = readPointStore(outStore)
+elif (extractionMode == 'collection'):
+    # Sample every image in a few server-side requests and split the long table into dates
+    print("Extracting point values for all images")
+    pointValues = extractCollectionValues(sentinelCollection, sample_locations, pixScale, 
+                                          numImages, getInfo(sample_locations.size()))
+    pointAttributes = pd.DataFrame(getValues(sample_locations))
+    for date, points in dateFrames(pointValues, pointAttributes).items():
+        extractedValues.update({date : addPointVariables(points)})
+elif (extractionMode == 'concurrent'):
+    # Extract the dates in parallel, retrying requests that fail with transient errors
+    dateValues, failedDates = extractDatesConcurrently(images, dateList, sample_locations, pixScale, 
+                                                       maxWorkers, maxRetries)
+    for date, dictarr in dateValues.items():
+        points = addPointVariables(gpd.GeoDataFrame(dictarr))
+        # Use band 3 to select only points not covered by clouds
+        if ('B3' in points):  
+            extractedValues.update({date : points})
+    if (len(failedDates) > 0):
+        print("\nThese dates could not be extracted: " + ", ".join(failedDates))
+else:
+    for index in range(0, numImages):
+        print("Processing " + dateList[index] + ": " + str(numImages - index - 1) + " images to go      ", end = "\r")
+        image = ee.Image(images.get(index))
+        extractedPoints = geemap.extract_values_to_points(sample_locations, image, scale=pixScale)
+        dictarr = getValues(extractedPoints)
+        points = gpd.GeoDataFrame(dictarr)
+        # Add the following variables to the collection of point data
+        points = addPointVariables(points)
+        
+        # Use band 3 to select only points not covered by clouds
+        if ('B3' in points):  
+            extractedValues.update({dateList[index] : points})
+        # Add the image layer for display
+        if (Map is not None):
+            Map.addLayer(image, sentinel_vis, dateList[index])
 
 # Add boundary to dispay images
-Map.addLayer(boundary_ee, {}, "Boundary EE")
+if (Map is not None):
+    Map.addLayer(boundary_ee, {}, "Boundary EE")
 
 # Display the map.
 Map
@@ -318,13 +489,21 @@ Map
 
 
 # Output the dictionary with all points - this will be input to the "StockSOC_ProcessPoints" Notebook
-with open(outPickle, 'wb') as handle:
-    pickle.dump(extractedValues, handle, protocol=pickle.HIGHEST_PROTOCOL)
+if (outPickle):
+    with open(outPickle, 'wb') as handle:
+        pickle.dump(extractedValues, handle, protocol=pickle.HIGHEST_PROTOCOL)
+# Output the point attributes once and the band values for each date as a long table
+if (outStore and not incremental):
+    writePointStore(outStore, extractedValues, 
+                    dict(zip(dateList, collectionMetadata['imageIDs'])))
 
 
 # In[23]:
 
 
+# Print the number of Earth Engine requests that were read from the cache
+print(cacheStats())
+
 # Print a list of all the image dates
 list(extractedValues.keys())
 
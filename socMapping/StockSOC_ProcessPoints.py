@@ -7,11 +7,12 @@
 # This script is used to process the data output form the “StockSOC_ExtractPoints” script. 
 # For each date where point data could be extracted from Sentinel imagery this script will 
 # determine the features (variables) that produce a linear regression with the best R2 value. 
-# You can specify the minimum and maximum number of features that are tested. Increasing the 
-# maximum number of features to four or higher requires significantly more processing time. Using 
+# You can specify the minimum and maximum number of features that are tested. The regressions 
+# for all of the feature subsets are solved from a single Gram matrix for each date (see 
+# "subsetRegression.py") so five or six features can be tested in a reasonable time. Using 
 # leave-one-out cross validation with the best linear model, the following metrics 
-# are calculated and writen to a CSV file that is output at the end of the script: 
-# R square, Adjusted R square, RMSE, and normalized RMSE. Processing progress can be monitored 
+# are calculated and writen to a CSV file as soon as each date is processed: 
+# R square, Adjusted R square, RMSE, normalized RMSE and predicted R square. Processing progress can be monitored 
 # by viewing the metrics for each date after that date has been processed.
 
 # This script was written by Ned Horning [ned.horning@regen.network]
@@ -25,20 +26,16 @@
 
 import json
 import os
-import math
 import requests
 from datetime import datetime
 import geopandas as gpd 
 import pandas as pd
 import pickle
-from sklearn import linear_model
-from sklearn.model_selection import LeaveOneOut
-from mlxtend.feature_selection import ExhaustiveFeatureSelector as EFS
-from sklearn.model_selection import train_test_split
-from sklearn.model_selection import cross_val_score
-from numpy import sqrt 
-from numpy import mean 
-from numpy import absolute
+from pointStore import readPointStore
+from runConfig import commandLineConfig, applyConfig
+from pointProcessing import processDates, addBatchedBestSubsets
+from spectralIndices import addIndexColumns
+from resultsWriter import resultRow, finishedDates, appendResult, checkResumeSettings
 
 
 # In[ ]:
@@ -47,6 +44,15 @@ from numpy import absolute
 ### Enter input file from "StockSOC_ExtractPoints" and output CSV file paths and names ###
 inPickle = ""
 outCSV = ""
+# Results are written to outCSV as each date is processed. When resumeResults is True the dates
+# already in outCSV are skipped, so a stopped run can be continued. The settings are saved with
+# the file and resuming stops with an error if they changed. When it is False a new file is
+# started (the existing file is deleted).
+resumeResults = False
+# To read the Parquet point store output from "StockSOC_ExtractPoints" instead of the pickle
+# file enter the store directory. Dates can be limited by entering a list of dates ('YYYY_MM_DD').
+inStore = ""
+storeDates = None
 
 
 # In[ ]:
@@ -66,173 +72,170 @@ PointLabel = 'MUESTRA'   # Attribute name for point labels
 min_feat=2
 max_feat=3
 
+### Criterion used to select the best subset of features: 'cv' for the adjusted R2 from k-fold 
+### cross validation or 'loo' for the predicted R2 from leave-one-out cross validation ###
+selectionCriterion = 'cv'
 
-# In[ ]:
-
-
-### Process stock. To process SOC change to False ###
-processStock = True
+### Subset search: 'exhaustive' tests every subset with the criterion above. 'branchAndBound' uses ###
+### the leaps and bounds search to find the subset with the best in-sample score (screenCriterion ###
+### below: 'adjr2', 'aic' or 'bic') without fitting every subset, so selectionCriterion isn't used ###
+### unless screenTopK is set. Use it when there are too many features (25-40) to test every subset. ###
+subsetSearch = 'exhaustive'
 
+### Two-stage screening: set screenTopK to a number of subsets to rank all subsets with a quick ###
+### in-sample score ('adjr2', 'aic' or 'bic') and run the cross validation only on the best ###
+### screenTopK subsets. Set auditScreening to True to also test every subset and report how often ###
+### the selected subset changes. Set screenTopK to None to cross validate every subset. ###
+screenTopK = None
+screenCriterion = 'adjr2'
+auditScreening = False
 
-# In[ ]:
+### Directory to save the subset scores for each date so they don't need to be calculated again ###
+### when the script is run with different settings (for example a larger max_feat). Leave empty ###
+### to turn off the cache. The scores aren't cached when batchAllDates is used. ###
+scoreCacheDir = ""
 
-
-### Maximum percentage of points with clouds. 
-max_cloud_percent = 0.2
+### Number of bootstrap samples used to calculate confidence intervals for the coefficients, R2 ###
+### and RMSE of the best regression for each date (0 to skip) and the confidence level ###
+nBootstrap = 0
+bootstrapConfidence = 0.95
 
 
 # In[ ]:
 
 
-# Function to calcualte normalized difference vegetation index
-def calcNDVI(red, nir):
-    return pd.DataFrame((nir - red)/(nir + red))
-
-
-# In[ ]:
+### Number of processes used to process dates at the same time (None to use all processors) ###
+numWorkers = None
 
-
-# Function to calcualte soil-adjusted total vegetation index
-def calcSATVI(red, swir1, swir2):
-    return pd.DataFrame(((swir1 -red)/(swir1 + red+0.5)) * 1.5 - (swir2/2))
+### Set to True to find the best subsets for all dates together with batched array calculations. ###
+### This is usually faster than processing the dates one at a time when there are many dates. ###
+batchAllDates = False
 
 
 # In[ ]:
 
 
-# Function to calcualte normalized burn ratio 2
-def calcNBR2(swir1, swir2):
-    return pd.DataFrame((swir1 -swir2)/(swir1 + swir2))
+### Process stock. To process SOC change to False ###
+processStock = True
 
 
 # In[ ]:
 
 
-# Function to calcualte soil organic carbon index
-def calcSOCI(blue, green, red):
-    return pd.DataFrame(blue/(red * green))
+### Maximum percentage of points with clouds. 
+max_cloud_percent = 0.2
 
 
 # In[ ]:
 
 
-# Function to calcualte bare soil index
-def calcBSI(blue, red, nir, swir1):
-    return pd.DataFrame((swir1 + red) -(nir + blue) / (swir1 + red) + (nir + blue))
+# Headless (batch) mode: to run the script without a notebook enter the name of a JSON file
+# with the parameters to use on the command line, e.g. "python StockSOC_ProcessPoints.py config.json". 
+# Parameters in the file replace the values entered above.
+configFile = commandLineConfig()
+if (configFile):
+    applyConfig(configFile, globals())
 
 
 # In[ ]:
 
 
-# Function to calcualte adjusted R2
-def adjust_r2(r2, num_examples, num_features):
-    coef = (num_examples - 1) / (num_examples - num_features - 1) 
-    return 1 - (1 - r2) * coef
+# Open the tabular data that was output from StockSOC_ExtractPoints
+if (inStore):
+    pointsDFs = readPointStore(inStore, dates=storeDates)
+else:
+    with open(inPickle, 'rb') as f:
+        pointsDFs = pickle.load(f)
 
 
 # In[ ]:
 
 
-# Open the tabular data that was output from StockSOC_ExtractPoints
-with open(inPickle, 'rb') as f:
-    pointsDFs = pickle.load(f)
-
-
-# In[ ]:
+# The branch-and-bound search can only select the subset with an in-sample score
+if (subsetSearch == 'branchAndBound' and not screenTopK):
+    print('The branch-and-bound search selects the subset with the in-sample ' + screenCriterion + 
+          ' score, not the ' + selectionCriterion + ' cross validation. Set screenTopK to cross ' +
+          'validate the best subsets it finds.')
 
+# Settings used to process each date
+settings = {'min_feat': min_feat, 'max_feat': max_feat, 'selectionCriterion': selectionCriterion,
+            'subsetSearch': subsetSearch, 'screenTopK': screenTopK,
+            'screenCriterion': screenCriterion, 'auditScreening': auditScreening,
+            'scoreCacheDir': scoreCacheDir, 'target': 'stock' if processStock else SOC,
+            'nBootstrap': nBootstrap, 'bootstrapConfidence': bootstrapConfidence}
 
-# Initialize for tabular data to be output to CSV
-regResults = pd.DataFrame(columns = ['Date', 'R2', 'Adjusted_R2', 'RMSE', 'BestFeatures'])
+# Get the dates that are already in the output CSV file so they aren't processed again. The
+# file is only resumed if it was created with the same settings.
+if (not resumeResults and os.path.exists(outCSV)):
+    os.remove(outCSV)
+resumeSettings = {key: value for key, value in settings.items() if key != 'scoreCacheDir'}
+checkResumeSettings(outCSV, dict(resumeSettings, max_cloud_percent=max_cloud_percent,
+                                 inputFile=inStore if inStore else inPickle))
+doneDates = finishedDates(outCSV)
+if (len(doneDates) > 0):
+    print('Skipping ' + str(len(doneDates)) + ' dates that are already in ' + outCSV)
 
 
 # In[ ]:
 
 
-# Iterate through the dictionary one date at a time to find the set of variables
-# that gives the highest R2 value
+# Iterate through the dictionary one date at a time to prepare the feature and target 
+# arrays for each date that has few enough points covered by clouds
+dateTasks = []
 for iteration, key in enumerate(pointsDFs):
+    if (key in doneDates):
+        continue
     points = pointsDFs[key]
     if (points['B3'].isna().sum() / len(points.index) < max_cloud_percent): 
-        print("Processing " + key + ": " + (str(len(pointsDFs.keys())-iteration-1)) + 
-              " images to go      ", end = "\r")
         points.dropna(inplace=True)
-        points['ndvi']= calcNDVI(points['B4'].astype(float), points['B8'].astype(float))
-        points['satvi']= calcSATVI(points['B4'].astype(float), points['B11'].astype(float), 
-                                   points['B12'].astype(float))
-        points['nbr2']= calcNBR2(points['B11'].astype(float), points['B12'].astype(float))
-        points['soci']= calcSOCI(points['B2'].astype(float), points['B3'].astype(float), 
-                                 points['B4'].astype(float))
-        points['bsi']= calcBSI(points['B2'].astype(float), points['B4'].astype(float), 
-                                 points['B8'].astype(float), points['B11'].astype(float))
-
-        x = pd.DataFrame(points.drop([SOC, BD, PointLabel, 'stock'], axis=1))
-        if (processStock):
-            y = points[['stock']]
-        else:
-            y = points[[SOC]]
-        # Set up for leave one out processig
-        loo = LeaveOneOut()
-        # Set up for linear regression model
-        regr = linear_model.LinearRegression()
-        # Execute exhaustive feature selection algorithm
-        efs = EFS(regr, 
-            min_features=min_feat,
-            max_features=max_feat,
-            scoring='r2',
-            cv=math.floor(len(points.index)/2))
-        efs.fit(x, y)
-        # Calculate adjusted R2
-        for i in efs.subsets_:
-            efs.subsets_[i]['adjusted_avg_score'] = (
-            adjust_r2(r2=efs.subsets_[i]['avg_score'],
-                  num_examples=x.shape[0]/1.0,
-                  num_features=len(efs.subsets_[i]['feature_idx']))
-            )
-        score = -99e10
-        # Select the best adjusted R2
-        for i in efs.subsets_:
-            score = efs.subsets_[i]['adjusted_avg_score']
-            if ( efs.subsets_[i]['adjusted_avg_score'] == score and
-                len(efs.subsets_[i]['feature_idx']) < len(efs.best_idx_) )\
-              or efs.subsets_[i]['adjusted_avg_score'] > score:
-                efs.best_idx_ = efs.subsets_[i]['feature_idx']
-
-        print('Best subset:', efs.best_feature_names_)
-        x = points[list(efs.best_feature_names_)]
+        # Add the spectral indices (ndvi, satvi, nbr2, soci, bsi) defined in spectralIndices.py
+        points = addIndexColumns(points)
+
+        x = pd.DataFrame(points.drop([SOC, BD, PointLabel, 'stock', 'pointID'], axis=1, errors='ignore'))
         if (processStock):
-            y = points[['stock']]
+            y = points['stock']
         else:
-            y = points[[SOC]]
-        
-        # Get the R2 Adjusted R2, RMSE and Normalize RMSE for the variable with the best fit
-        #regr = linear_model.LinearRegression()
-        fitTOC = regr.fit(x, y)
-        R2TOC = fitTOC.score(x,y)
-        Adjusted_R2 = 1 - (1-fitTOC.score(x, y))*(len(y)-1)/(len(y)-x.shape[1]-1)
-        
-        # Calculate RMSE and Normalized RMSE using leave one out cross validation
-        cv = LeaveOneOut()
-        scores = cross_val_score(regr, x, y, scoring='neg_mean_squared_error',
-                         cv=cv, n_jobs=-1)
-        RMSE = sqrt(mean(absolute(scores)))
-        NRMSE = RMSE/list(y.mean())[0]
-        
-        # Print values to monitor processing
-        print('R2 score: {:.2f}'.format(R2TOC))
-        print('Adjusted R2 score: {:.2f}'.format(Adjusted_R2))
-        print('RMSE: {:.2f}'.format(RMSE))
-        print('NRMSE: {:.2f}'.format(NRMSE))
-        
-        # Append results to the table that will be outupt as a CSV file
-        regResults = regResults.append({'Date' : key, 'R2' : R2TOC, 'Adjusted_R2' : Adjusted_R2, 
-                                        'RMSE' : RMSE, 'NRMSE' : NRMSE, 'BestFeatures' : efs.best_feature_names_, 
-                                        'Intercept' : fitTOC.intercept_, 'Coefficients' : fitTOC.coef_}, 
-                                       ignore_index = True)
+            y = points[SOC]
+        dateTasks.append((key, x.to_numpy(dtype=float), y.to_numpy(dtype=float), list(x.columns), 
+                          settings))
+
+
+# In[ ]:
+
+
+# Find the best subsets for all of the dates in one pass (only used with the exhaustive search)
+if (batchAllDates and subsetSearch == 'exhaustive' and not screenTopK):
+    dateTasks = addBatchedBestSubsets(dateTasks)
 
 
 # In[ ]:
 
 
-# Output tabular data to CSV file
-regResults.to_csv(outCSV, index=False)
+# Find the set of variables that gives the highest R2 value for each date. The dates are 
+# processed in parallel and the results are printed in date order and written to the CSV file
+# as they are finished.
+screeningChanges = []
+for iteration, result in enumerate(processDates(dateTasks, numWorkers)):
+    print("Processed " + result['Date'] + ": " + str(len(dateTasks)-iteration-1) + 
+          " images to go      ")
+    print('Best subset:', result['BestFeatures'])
+    
+    # Print values to monitor processing
+    print('R2 score: {:.2f}'.format(result['R2']))
+    print('Adjusted R2 score: {:.2f}'.format(result['Adjusted_R2']))
+    print('RMSE: {:.2f}'.format(result['RMSE']))
+    print('NRMSE: {:.2f}'.format(result['NRMSE']))
+    print('Predicted R2 score: {:.2f}'.format(result['Predicted_R2']))
+    if ('R2_Low' in result):
+        print('R2 confidence interval: {:.2f} to {:.2f}'.format(result['R2_Low'], result['R2_High']))
+        print('RMSE confidence interval: {:.2f} to {:.2f}'.format(result['RMSE_Low'], result['RMSE_High']))
+    if ('ScreeningChanged' in result):
+        screeningChanges.append(result['ScreeningChanged'])
+        print('Screening changed the best subset:', result['ScreeningChanged'])
+    
+    # Append results to the CSV file
+    appendResult(outCSV, resultRow(result, max_feat))
 
+if (len(screeningChanges) > 0):
+    print('Screening changed the best subset for ' + str(sum(screeningChanges)) + ' of ' + 
+          str(len(screeningChanges)) + ' dates')
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Functions to score every subset of features for every date at the same time. The feature
+# arrays for all dates are stacked into a dates x points x features array. Dates have
+# different numbers of points after the cloudy points are dropped, so the arrays are padded
+# with rows of zeros and a mask. A row of zeros (including the intercept column) adds nothing
+# to the Gram matrix so the padded rows don't change the regressions. The same cross
+# validation (k-fold with floor(n/2) folds) and leave-one-out scores calculated for each date
+# in "subsetRegression.py" and "looMetrics.py" are calculated here with a few large NumPy
+# operations instead of thousands of small ones.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import math
+import numpy as np
+from subsetRegression import adjust_r2, featureSubsets, kFolds, solveNormal, subsetColumns
+
+
+# Maximum number of date and subset combinations solved at the same time, to limit memory use
+BATCH_SIZE = 50000
+
+
+# Function to stack the feature and target arrays for a list of dates. Features are centered
+# and scaled for each date using only the valid points, and the intercept column is added.
+# Output is the design array (dates x points x (features + 1)), the target array
+# (dates x points) and the mask of valid points (dates x points).
+def stackDates(xs, ys):
+    numPoints = max(len(y) for y in ys)
+    numCols = np.shape(xs[0])[1] + 1
+    X = np.zeros((len(xs), numPoints, numCols))
+    Y = np.zeros((len(xs), numPoints))
+    mask = np.zeros((len(xs), numPoints), dtype=bool)
+    for d, (x, y) in enumerate(zip(xs, ys)):
+        x = np.asarray(x, dtype=float)
+        scale = x.std(axis=0)
+        scale[scale == 0] = 1
+        n = len(y)
+        X[d, :n, 0] = 1
+        X[d, :n, 1:] = (x - x.mean(axis=0)) / scale
+        Y[d, :n] = np.asarray(y, dtype=float).ravel()
+        mask[d, :n] = True
+    return X, Y, mask
+
+
+# Function to create the k-fold cross validation folds for each date as padded arrays of point
+# indices (dates x folds x fold size) and a mask of the valid entries. Each date uses
+# floor(n/2) folds like the single date processing.
+def stackFolds(numPoints):
+    folds = [kFolds(n, math.floor(n / 2)) for n in numPoints]
+    numFolds = max(len(f) for f in folds)
+    foldSize = max(len(part) for f in folds for part in f)
+    rows = np.zeros((len(folds), numFolds, foldSize), dtype=np.intp)
+    foldMask = np.zeros((len(folds), numFolds, foldSize), dtype=bool)
+    for d, dateFolds in enumerate(folds):
+        for f, part in enumerate(dateFolds):
+            rows[d, f, :len(part)] = part
+            foldMask[d, f, :len(part)] = True
+    return rows, foldMask
+
+
+# Function to calculate the average k-fold cross validated R2 for each date and subset
+# (dates x subsets), the same score calculated by subsetRegression.cvScores for one date
+def cvScoresAllDates(X, Y, mask, subsets):
+    numDates = X.shape[0]
+    numPoints = mask.sum(axis=1)
+    rows, foldMask = stackFolds(numPoints)
+    dateIndex = np.arange(numDates)[:, None]
+    G = np.einsum('dni,dnj->dij', X, X)
+    c = np.einsum('dni,dn->di', X, Y)
+
+    scores = np.zeros((numDates, len(subsets)))
+    sizes = np.array([len(s) for s in subsets])
+    chunkSize = max(1, BATCH_SIZE // numDates)
+    for k in np.unique(sizes):
+        groupIndex = np.flatnonzero(sizes == k)
+        for start in range(0, len(groupIndex), chunkSize):
+            chunk = groupIndex[start:start + chunkSize]
+            cols = subsetColumns([subsets[i] for i in chunk])
+            total = np.zeros((numDates, len(chunk)))
+            for f in range(rows.shape[1]):
+                fm = foldMask[:, f, :]
+                Xf = X[dateIndex, rows[:, f, :]] * fm[:, :, None]
+                yf = Y[dateIndex, rows[:, f, :]] * fm
+                Gtrain = G - np.einsum('dsi,dsj->dij', Xf, Xf)
+                cTrain = c - np.einsum('dsi,ds->di', Xf, yf)
+                beta = solveNormal(Gtrain[:, cols[:, :, None], cols[:, None, :]], cTrain[:, cols])
+                predicted = np.einsum('dsmj,dmj->dms', Xf[:, :, cols], beta)
+                ssRes = (((yf[:, None, :] - predicted) ** 2) * fm[:, None, :]).sum(axis=2)
+                foldCount = fm.sum(axis=1)
+                foldMean = yf.sum(axis=1) / np.maximum(foldCount, 1)
+                ssTot = (((yf - foldMean[:, None]) ** 2) * fm).sum(axis=1)[:, None]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    r2 = np.where(ssTot == 0, np.where(ssRes == 0, 1.0, 0.0), 1 - ssRes / ssTot)
+                total += np.where(foldCount[:, None] > 0, r2, 0)
+            scores[:, chunk] = total / (foldMask.any(axis=2).sum(axis=1))[:, None]
+    return scores
+
+
+# Function to calculate the leave-one-out predicted R2 for each date and subset
+# (dates x subsets), the same score calculated by looMetrics.looSubsetScores for one date
+def looScoresAllDates(X, Y, mask, subsets):
+    numDates = X.shape[0]
+    G = np.einsum('dni,dnj->dij', X, X)
+    c = np.einsum('dni,dn->di', X, Y)
+    numPoints = mask.sum(axis=1)
+    means = Y.sum(axis=1) / numPoints
+    ssTot = (((Y - means[:, None]) ** 2) * mask).sum(axis=1)[:, None]
+
+    scores = np.zeros((numDates, len(subsets)))
+    sizes = np.array([len(s) for s in subsets])
+    # The leverage needs an array with all points for each date and subset so use smaller chunks
+    chunkSize = max(1, BATCH_SIZE * 10 // (numDates * X.shape[1]))
+    for k in np.unique(sizes):
+        groupIndex = np.flatnonzero(sizes == k)
+        for start in range(0, len(groupIndex), chunkSize):
+            chunk = groupIndex[start:start + chunkSize]
+            cols = subsetColumns([subsets[i] for i in chunk])
+            Gs = G[:, cols[:, :, None], cols[:, None, :]]
+            try:
+                Ginv = np.linalg.inv(Gs)
+            except np.linalg.LinAlgError:
+                Ginv = np.linalg.pinv(Gs)
+            beta = np.einsum('dmjl,dml->dmj', Ginv, c[:, cols])
+            Xs = X[:, :, cols]
+            residuals = (Y[:, None, :] - np.einsum('dnmj,dmj->dmn', Xs, beta)) * mask[:, None, :]
+            leverage = np.einsum('dnmj,dmjl,dnml->dmn', Xs, Ginv, Xs)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                press = ((residuals / (1 - leverage)) ** 2).sum(axis=2)
+            scores[:, chunk] = np.where(np.isfinite(press), 1 - press / ssTot, -np.inf)
+    return scores
+
+
+# Function to find the best subset of features for all dates at once. xs and ys are lists with
+# the feature and target arrays for each date (all dates must have the same features).
+# criterion is 'cv' for the adjusted k-fold cross validated R2 or 'loo' for the leave-one-out
+# predicted R2. Output is a list with the best subset (tuple of feature indices) for each date.
+def bestSubsetsAllDates(xs, ys, minFeat, maxFeat, criterion='cv'):
+    X, Y, mask = stackDates(xs, ys)
+    subsets = featureSubsets(X.shape[2] - 1, minFeat, maxFeat)
+    if (criterion == 'loo'):
+        scores = looScoresAllDates(X, Y, mask, subsets)
+    else:
+        scores = cvScoresAllDates(X, Y, mask, subsets)
+        numPoints = mask.sum(axis=1)[:, None]
+        sizes = np.array([len(s) for s in subsets])[None, :]
+        scores = adjust_r2(scores, numPoints, sizes)
+    # Subsets are ordered by the number of features so argmax selects the subset with fewer
+    # features when scores are equal
+    return [subsets[i] for i in np.argmax(scores, axis=1)]
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Bootstrap confidence intervals for the linear regression selected for each date by
+# "StockSOC_ProcessPoints". All of the resampled sample indices are drawn at once and the
+# regressions for all of the bootstrap samples are solved together from a stack of Gram
+# matrices, so 1000 or more bootstrap samples take a fraction of a second instead of one
+# scikit-learn fit for each sample.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import numpy as np
+from subsetRegression import solveNormal
+
+
+# Maximum number of bootstrap samples solved at the same time, to limit memory use
+BOOTSTRAP_CHUNK = 5000
+
+
+# Function to fit the regression to nBootstrap resamples of the points. x is the array of
+# features (samples x features) and y the values to predict. Output is the array of
+# coefficients (intercept first) and the R2 and RMSE of each fit.
+def bootstrapFits(x, y, nBootstrap=1000, seed=0):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float).ravel()
+    numSamples = len(y)
+    # Center and scale the features to keep the Gram matrices well conditioned and convert the
+    # coefficients back to the original units at the end
+    mean = x.mean(axis=0)
+    scale = x.std(axis=0)
+    scale[scale == 0] = 1
+    X = np.hstack([np.ones((numSamples, 1)), (x - mean) / scale])
+    resamples = np.random.default_rng(seed).integers(0, numSamples, size=(nBootstrap, numSamples))
+
+    beta = np.zeros((nBootstrap, X.shape[1]))
+    r2 = np.zeros(nBootstrap)
+    rmse = np.zeros(nBootstrap)
+    for start in range(0, nBootstrap, BOOTSTRAP_CHUNK):
+        rows = resamples[start:start + BOOTSTRAP_CHUNK]
+        Xb = X[rows]
+        yb = y[rows]
+        b = solveNormal(np.einsum('bni,bnj->bij', Xb, Xb), np.einsum('bni,bn->bi', Xb, yb))
+        residuals = yb - np.einsum('bnj,bj->bn', Xb, b)
+        ssRes = (residuals ** 2).sum(axis=1)
+        ssTot = ((yb - yb.mean(axis=1)[:, None]) ** 2).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r2[start:start + len(rows)] = np.where(ssTot > 0, 1 - ssRes / ssTot, np.nan)
+        rmse[start:start + len(rows)] = np.sqrt(ssRes / numSamples)
+        beta[start:start + len(rows)] = b
+
+    coefficients = beta[:, 1:] / scale
+    intercept = beta[:, 0] - coefficients @ mean
+    return np.column_stack([intercept, coefficients]), r2, rmse
+
+
+# Function to calculate percentile bootstrap confidence intervals for the intercept,
+# coefficients, R2 and RMSE. confidence is the confidence level (0.95 for 95% intervals).
+# Output is a dictionary with the lower and upper limits that is added to the results.
+def bootstrapIntervals(x, y, nBootstrap=1000, confidence=0.95, seed=0):
+    coefficients, r2, rmse = bootstrapFits(x, y, nBootstrap, seed)
+    limits = [50 * (1 - confidence), 50 * (1 + confidence)]
+    coefLimits = np.nanpercentile(coefficients, limits, axis=0)
+    r2Limits = np.nanpercentile(r2, limits)
+    rmseLimits = np.nanpercentile(rmse, limits)
+    return {'Intercept_Low': coefLimits[0, 0], 'Intercept_High': coefLimits[1, 0],
+            'Coef_Low': coefLimits[0, 1:], 'Coef_High': coefLimits[1, 1:],
+            'R2_Low': r2Limits[0], 'R2_High': r2Limits[1],
+            'RMSE_Low': rmseLimits[0], 'RMSE_High': rmseLimits[1]}
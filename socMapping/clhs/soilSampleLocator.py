@@ -25,6 +25,15 @@ import geopandas as gpd
 import pandas as pd
 import math
 import numpy as np
+import sys
+
+# Helper modules shared with the scripts in the socMapping directory
+scriptDir = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+sys.path.append(os.path.join(scriptDir, '..'))
+from eeCache import useCache, getInfo
+from runConfig import commandLineConfig, applyConfig
+from eeExport import exportTiled
+from datetime import datetime
 
 #ee.Authenticate()
 ee.Initialize()
@@ -34,8 +43,8 @@ ee.Initialize()
 
 
 ### Enter start and end date as numbers for year, month, day to calculate max NDVI ###
-startDate = ee.Date.fromYMD(2021, 1, 1)
-endDate = ee.Date.fromYMD(2021, 12, 31)
+startDate = datetime(2021, 1, 1)
+endDate = datetime(2021, 12, 31)
 
 # Enter the number of samples to place in the area
 numSamples = 30
@@ -59,6 +68,32 @@ buffer = 50
 boundaryShp = "/home/nedhorning/RegenNetwork/Soils/Gunningham/Grazing Area Maps/MergedProperties.shp"
 outImage = "/home/nedhorning/RegenNetwork/Soils/Gunningham/MergedPropertiesTest.tif"
 
+# Directory to save Earth Engine results so they don't need to be requested again when the
+# script is run with the same settings. Leave empty to turn off the cache.
+cacheDir = ""
+
+# Download the image as a grid of tiles that are combined into a single float32 image (see
+# eeExport.py) so large areas can be downloaded. exportWorkers is the number of tiles downloaded
+# at the same time. Set tiledExport to False to download the whole area in one request.
+tiledExport = True
+exportWorkers = 8
+
+
+# In[ ]:
+
+
+# Headless (batch) mode: to run the script without a notebook enter the name of a JSON file
+# with the parameters to use on the command line, e.g. "python soilSampleLocator.py config.json". 
+# Parameters in the file replace the values entered above and no maps are created.
+configFile = commandLineConfig()
+if (configFile):
+    applyConfig(configFile, globals())
+showMap = not configFile
+
+# Save the results of Earth Engine requests in cacheDir so identical requests are only sent once
+if (cacheDir):
+    useCache(cacheDir)
+
 
 # In[5]:
 
@@ -200,7 +235,7 @@ def addSlope(image):
 
 # Function make the server-side feature collection accessible to the client
 def getValues(fc):
-    features = fc.getInfo()['features']
+    features = getInfo(fc)['features']
     dictarr = []
     for f in features:
         attr = f['properties']
@@ -301,20 +336,27 @@ predictorImage3 = addSlope(predictorImage2)
 # In[25]:
 
 
-Map=geemap.Map()
-Map.centerObject(boundary_ee, 13)
-Map.addLayer(predictorImage3, ndviViz)
-Map.addLayer(boundary_ee, {}, "Boundary EE")
+Map = None
+if (showMap):
+    Map=geemap.Map()
+    Map.centerObject(boundary_ee, 13)
+    Map.addLayer(predictorImage3, ndviViz)
+    Map.addLayer(boundary_ee, {}, "Boundary EE")
 Map
 
 
 # In[26]:
 
 
+# The image is exported in EPSG:4326 like the single request export, because clhsPlotLocation.R
+# uses the image and the boundary without reprojecting them
 image = predictorImage3.clip(boundary_ee.geometry()).unmask()
-geemap.ee_export_image(
-    image, filename=outImage, scale=pixScale, region=boundary_ee.geometry(), file_per_band=False
-)
+if (tiledExport):
+    exportTiled(image, outImage, boundary_ee.geometry(), pixScale, exportWorkers, crs='EPSG:4326')
+else:
+    geemap.ee_export_image(
+        image, filename=outImage, scale=pixScale, region=boundary_ee.geometry(), file_per_band=False
+    )
 
 
 # In[ ]:
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# A local cache for the results of Earth Engine getInfo requests. Each result is saved in a
+# JSON file named with a hash of the serialized Earth Engine computation graph so running a
+# script again only sends requests for the graphs that changed (for example after changing
+# CLOUD_PROBABILITY_THRESHOLD or pixScale). Results older than the time-to-live are requested
+# again and the least recently used results are deleted when the cache gets too large.
+
+# To use the cache call useCache(cacheDir) and then getInfo(eeObject) instead of
+# eeObject.getInfo(). If useCache is not called getInfo sends the request as usual.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class EECache:
+    # cacheDir is the cache directory, maxBytes the maximum size of all cached results and
+    # ttlDays the number of days a result is used before it's requested again
+    def __init__(self, cacheDir, maxBytes=500 * 1024 ** 2, ttlDays=30):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.ttl = ttlDays * 86400
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cacheDir, exist_ok=True)
+
+    # Function to get the cache file name for an Earth Engine object
+    def cacheFile(self, eeObject):
+        graphHash = hashlib.sha256(eeObject.serialize().encode('utf-8')).hexdigest()
+        return os.path.join(self.cacheDir, 'getinfo_' + graphHash + '.json')
+
+    # Function to return the cached result for an Earth Engine object or request it with
+    # getInfo and save it in the cache. The file time is updated on every use so the least
+    # recently used results are the first to be deleted.
+    def getInfo(self, eeObject):
+        path = self.cacheFile(eeObject)
+        try:
+            with open(path, 'r') as f:
+                cached = json.load(f)
+            if (time.time() - cached['created'] < self.ttl):
+                os.utime(path)
+                with self.lock:
+                    self.hits += 1
+                return cached['result']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        result = eeObject.getInfo()
+        with self.lock:
+            self.misses += 1
+        # Write to a temporary file first so other threads never read a partial file
+        handle, tmpPath = tempfile.mkstemp(dir=self.cacheDir, suffix='.tmp')
+        with os.fdopen(handle, 'w') as f:
+            json.dump({'created': time.time(), 'result': result}, f)
+        os.replace(tmpPath, path)
+        self.evict()
+        return result
+
+    # Function to delete expired results and then the least recently used results until the
+    # cache is smaller than maxBytes
+    def evict(self):
+        with self.lock:
+            files = []
+            for name in os.listdir(self.cacheDir):
+                if (name.startswith('getinfo_')):
+                    path = os.path.join(self.cacheDir, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+            files.sort()
+            totalBytes = sum(f[1] for f in files)
+            now = time.time()
+            for mtime, size, path in files:
+                if (totalBytes <= self.maxBytes and now - mtime < self.ttl):
+                    continue
+                try:
+                    os.remove(path)
+                    totalBytes -= size
+                except OSError:
+                    pass
+
+    # Function to get the number of cache hits and misses and the cache size
+    def stats(self):
+        files = [os.path.join(self.cacheDir, n) for n in os.listdir(self.cacheDir)
+                 if n.startswith('getinfo_')]
+        return {'hits': self.hits, 'misses': self.misses, 'files': len(files),
+                'bytes': sum(os.path.getsize(f) for f in files)}
+
+
+# Cache used by getInfo, set with useCache
+activeCache = None
+
+
+# Function to turn on the getInfo cache
+def useCache(cacheDir, maxBytes=500 * 1024 ** 2, ttlDays=30):
+    global activeCache
+    activeCache = EECache(cacheDir, maxBytes, ttlDays)
+    return activeCache
+
+
+# Function to get the result of an Earth Engine object, using the cache if it's turned on
+def getInfo(eeObject):
+    if (activeCache is None):
+        return eeObject.getInfo()
+    return activeCache.getInfo(eeObject)
+
+
+# Function to get the cache statistics (hits, misses, files, bytes)
+def cacheStats():
+    if (activeCache is None):
+        return {'hits': 0, 'misses': 0, 'files': 0, 'bytes': 0}
+    return activeCache.stats()
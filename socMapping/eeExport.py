@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Functions to download an Earth Engine image for a large area as a grid of tiles. Each
+# getDownloadURL request is limited in size so exporting a whole property in one request can
+# fail, and converting the image to int16 to make it smaller loses precision. Instead, the
+# boundary is split into tiles small enough for one request, the tiles are downloaded at the
+# same time (with retries for transient errors) and written into a single float32 GeoTIFF.
+# The tiles use the same pixel grid so they line up exactly in the output image. By default the
+# grid is in meters (the image's own projection, or the UTM zone of the boundary for composites
+# that don't have one) so each pixel covers pixScale x pixScale meters. Another projection can
+# be given, for example EPSG:4326 to match older outputs.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import math
+import os
+import ee
+import numpy as np
+import rasterio
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from rasterio.crs import CRS
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+from eeExtraction import retryEE
+from eeCache import getInfo
+
+
+# Value used for masked pixels in the output image
+EXPORT_NODATA = -9999.0
+
+# Maximum size of one tile (uncompressed), below the getDownloadURL request size limit
+MAX_TILE_BYTES = 32 * 1024 ** 2
+
+# Approximate number of meters in one degree at the equator, to convert the pixel size for
+# projections in degrees (the same conversion Earth Engine uses for the scale in meters)
+METERS_PER_DEGREE = 111319.49
+
+# HTTP status codes that are worth retrying
+TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+
+
+# Function to get the UTM zone (EPSG code) for the center of a longitude/latitude bounding box
+def utmZone(west, south, east, north):
+    zone = int(((west + east) / 2 + 180) // 6) % 60 + 1
+    return 'EPSG:' + str((32600 if (south + north) / 2 >= 0 else 32700) + zone)
+
+
+# Function to get the projection to export an image in. Images from one scene keep their own
+# projection (the first band's). Composites and calculated images that only have the default
+# EPSG:4326 projection (or another projection in degrees) use the UTM zone of the region so the
+# pixel size stays in meters.
+def exportCRS(image, region):
+    crs = getInfo(image.select(0).projection()).get('crs')
+    if (not crs or CRS.from_user_input(crs).is_geographic):
+        corners = np.array(getInfo(region.bounds())['coordinates'][0])
+        crs = utmZone(*corners.min(axis=0), *corners.max(axis=0))
+    return crs
+
+
+# Function to create the pixel grid for a region in crs. The pixel size is pixScale meters,
+# converted to degrees if crs is in degrees. The grid origin is a multiple of the pixel size so
+# images exported with the same pixScale and crs line up. Output is the grid transform, the
+# width and height in pixels and the tile size in pixels.
+def exportGrid(region, pixScale, numBands, crs, maxTileBytes=MAX_TILE_BYTES):
+    corners = np.array(getInfo(region.bounds())['coordinates'][0])
+    west, south, east, north = transform_bounds('EPSG:4326', crs, *corners.min(axis=0),
+                                                *corners.max(axis=0), densify_pts=21)
+    pixSize = pixScale / METERS_PER_DEGREE if CRS.from_user_input(crs).is_geographic else pixScale
+    originX = math.floor(west / pixSize) * pixSize
+    originY = math.ceil(north / pixSize) * pixSize
+    width = max(1, math.ceil((east - originX) / pixSize))
+    height = max(1, math.ceil((originY - south) / pixSize))
+    tileSize = int(math.sqrt(maxTileBytes / (4 * numBands)))
+    return Affine(pixSize, 0, originX, 0, -pixSize, originY), width, height, tileSize
+
+
+# Function to list the tiles in a grid as windows of the output image
+def gridTiles(width, height, tileSize):
+    return [Window(c, r, min(tileSize, width - c), min(tileSize, height - r))
+            for r in range(0, height, tileSize) for c in range(0, width, tileSize)]
+
+
+# Function to download one tile as a GeoTIFF. Output is the tile as a float32 array
+# (bands x rows x columns). Network errors and HTTP errors that are worth retrying are raised as
+# ConnectionError so retryEE tries again.
+def downloadTile(image, crs, transform, window, timeout=300):
+    tileTransform = rasterio.windows.transform(window, transform)
+    url = image.getDownloadURL({
+        'format': 'GEO_TIFF',
+        'crs': crs,
+        'crs_transform': list(tileTransform)[:6],
+        'dimensions': str(int(window.width)) + 'x' + str(int(window.height))})
+    try:
+        response = requests.get(url, timeout=timeout)
+    except requests.exceptions.RequestException as err:
+        raise ConnectionError(str(err))
+    if (response.status_code in TRANSIENT_STATUS):
+        raise ConnectionError('HTTP ' + str(response.status_code) + ': ' + response.text[:200])
+    if (response.status_code != 200):
+        raise ee.EEException('HTTP ' + str(response.status_code) + ': ' + response.text[:500])
+    with MemoryFile(response.content) as memFile, memFile.open() as src:
+        return src.read(out_dtype='float32')
+
+
+# Function to export an image for a region as float32 GeoTIFF by downloading tiles at the
+# same time with maxWorkers threads and writing each tile into the output image when it
+# arrives. Masked pixels and pixels outside the region are set to EXPORT_NODATA. crs is the
+# output projection (None to use exportCRS).
+def exportTiled(image, outPath, region, pixScale, maxWorkers=8, maxRetries=5, baseDelay=2.0,
+                maxTileBytes=MAX_TILE_BYTES, crs=None):
+    bandNames = getInfo(image.bandNames())
+    crs = crs or exportCRS(image, region)
+    image = image.toFloat().clip(region).unmask(EXPORT_NODATA, False)
+    transform, width, height, tileSize = exportGrid(region, pixScale, len(bandNames), crs, maxTileBytes)
+    tiles = gridTiles(width, height, tileSize)
+    profile = {'driver': 'GTiff', 'width': width, 'height': height, 'count': len(bandNames),
+               'dtype': 'float32', 'crs': crs, 'transform': transform,
+               'nodata': EXPORT_NODATA, 'tiled': True, 'blockxsize': 256, 'blockysize': 256,
+               'compress': 'deflate', 'predictor': 3, 'BIGTIFF': 'IF_SAFER'}
+
+    # If a tile still fails after the retries the tiles that haven't started are cancelled and the
+    # incomplete output image is deleted before the error is raised
+    executor = ThreadPoolExecutor(max_workers=maxWorkers)
+    try:
+        with rasterio.open(outPath, 'w', **profile) as dst:
+            for i, name in enumerate(bandNames):
+                dst.set_band_description(i + 1, name)
+            futures = {executor.submit(retryEE, lambda w=window: downloadTile(image, crs, transform, w),
+                                       maxRetries, baseDelay): window for window in tiles}
+            for index, future in enumerate(as_completed(futures)):
+                dst.write(future.result(), window=futures[future])
+                print("Downloaded tile " + str(index + 1) + " of " + str(len(tiles)) + "      ",
+                      end = "\r")
+    except Exception as err:
+        executor.shutdown(wait=False, cancel_futures=True)
+        print("\nFailed to download " + outPath + ": " + str(err))
+        if (os.path.exists(outPath)):
+            os.remove(outPath)
+        raise
+    executor.shutdown()
+    return outPath
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Helper functions used by the "StockSOC_ExtractPoints" script to extract Sentinel image
+# band values for the soil sample point locations using Google Earth Engine. Instead of
+# requesting the point values one image at a time, the functions in this file sample every
+# image in a collection in a single server-side graph and return a long table with one row
+# for each point and image date.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import ee
+import geemap
+import pandas as pd
+import random
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pointStore import readPointValues, appendPointValues
+from eeCache import getInfo
+
+
+# Maximum number of features Earth Engine will return from a single getInfo request
+MAX_FEATURES_PER_REQUEST = 5000
+
+# Number of days after an image is acquired that it can still be added to the Sentinel-2
+# collection. The collection metadata is only cached when the end date is older than this.
+INGEST_LAG_DAYS = 7
+
+# Parts of Earth Engine error messages for errors that usually go away when the request
+# is sent again (rate limits, quotas and computation timeouts)
+TRANSIENT_ERRORS = ('too many requests', 'too many concurrent', 'rate limit', 'quota exceeded',
+                    'computation timed out', 'deadline exceeded', 'service unavailable',
+                    'internal error', '429', '503')
+
+
+# Function to check if an error is a transient Earth Engine or network error
+def isTransientError(err):
+    if isinstance(err, (ConnectionError, TimeoutError)):
+        return True
+    message = str(err).lower()
+    return isinstance(err, ee.EEException) and any(m in message for m in TRANSIENT_ERRORS)
+
+
+# Function to run an Earth Engine request and retry it with exponential backoff (plus some
+# random jitter) when it fails with a transient error. Other errors are raised right away.
+def retryEE(request, maxRetries=5, baseDelay=2.0):
+    for attempt in range(maxRetries + 1):
+        try:
+            return request()
+        except Exception as err:
+            if (attempt == maxRetries or not isTransientError(err)):
+                raise
+            time.sleep(baseDelay * 2 ** attempt * (1 + random.random()))
+
+
+# Function make the server-side feature collection accessible to the client
+def getValues(fc):
+    features = getInfo(fc)['features']
+    dictarr = []
+    for f in features:
+        attr = f['properties']
+        dictarr.append(attr)
+    return dictarr
+
+
+# Function to get the size, dates, system:index and cloud percentage of every image in a
+# collection with a single request. endDate is the end of the collection's date range. The
+# result is only taken from the Earth Engine request cache (eeCache) when endDate is more than
+# INGEST_LAG_DAYS days ago. If endDate is recent, in the future or not given, new images can
+# still be added to the collection so the request is always sent (incremental runs need this
+# to find the new images).
+def getCollectionMetadata(collection, endDate=None):
+    properties = ['system:time_start', 'system:index', 'CLOUDY_PIXEL_PERCENTAGE']
+    columns = collection.reduceColumns(ee.Reducer.toList(len(properties)), properties).get('list')
+    closed = endDate is not None and endDate < datetime.now() - timedelta(days=INGEST_LAG_DAYS)
+    rows = retryEE(lambda: getInfo(columns) if closed else columns.getInfo())
+    metadata = {
+        'size': len(rows),
+        'dates': [datetime.utcfromtimestamp(r[0] / 1000).strftime('%Y_%m_%d') for r in rows],
+        'timeStart': [r[0] for r in rows],
+        'imageIDs': [r[1] for r in rows],
+        'cloudPercent': [r[2] for r in rows]}
+    return metadata
+
+
+# Function to keep only the images with the given system:index values in the collection metadata
+def subsetMetadata(collectionMetadata, imageIDs):
+    keep = set(imageIDs)
+    indices = [i for i, imageID in enumerate(collectionMetadata['imageIDs']) if imageID in keep]
+    subset = {key: [values[i] for i in indices] for key, values in collectionMetadata.items()
+              if isinstance(values, list)}
+    subset['size'] = len(indices)
+    return subset
+
+
+# Function to calculate the fraction of sample points that are masked (cloud or shadow) in
+# each image of a collection. The calculation for all images is done on the server and only
+# the system:index and the masked fraction are downloaded in a single request. Output is a
+# dictionary with the masked fraction for each system:index.
+def pointCloudFractions(collection, points, scale, numPoints, checkBand='B3'):
+    locations = points.select([])
+
+    def maskedFraction(img):
+        validPoints = (img.select(checkBand).mask().rename('valid')
+                       .reduceRegions(collection=locations, reducer=ee.Reducer.first(), scale=scale)
+                       .aggregate_sum('first'))
+        return img.set('pointCloudFraction', 
+                       ee.Number(1).subtract(ee.Number(validPoints).divide(numPoints)))
+
+    properties = ['system:index', 'pointCloudFraction']
+    columns = (collection.map(maskedFraction)
+               .reduceColumns(ee.Reducer.toList(len(properties)), properties).get('list'))
+    return {imageID: fraction for imageID, fraction in retryEE(lambda: getInfo(columns))}
+
+
+# Function to add a point identifier attribute to each sample point. The feature ID
+# assigned when the Shapefile is converted to a GEE feature collection is used so the
+# identifier stays the same each time the script is run.
+def addPointID(points, idField='pointID'):
+    return points.map(lambda f: f.set(idField, f.id()))
+
+
+# Function to sample all images in a collection at the point locations. The output is a
+# flat feature collection with one feature for each point and image holding the point ID,
+# the image date and system:index, and the band values. Masked (cloudy) pixels have no value.
+def sampleCollection(collection, points, scale, idField='pointID'):
+    pointIDs = points.select([idField])
+
+    def sampleImage(img):
+        date = img.date().format('YYYY_MM_dd')
+        imageID = img.get('system:index')
+        samples = img.reduceRegions(collection=pointIDs, reducer=ee.Reducer.first(), scale=scale)
+        return samples.map(lambda f: f.set({'date': date, 'imageID': imageID}))
+
+    return ee.FeatureCollection(collection.map(sampleImage)).flatten()
+
+
+# Function to extract the values of single-band images that don't change over time (TWI,
+# CHILI) at the point locations with one request. images is a dictionary with the output
+# column name and the image. Output is a table with the point ID and a column for each image.
+def extractStaticImageValues(points, images, scale, idField='pointID'):
+    stack = ee.Image.cat([image.select([0]).rename(name) for name, image in images.items()])
+    samples = stack.reduceRegions(collection=points.select([idField]), reducer=ee.Reducer.first(),
+                                  scale=scale)
+    staticValues = pd.DataFrame(retryEE(lambda: getValues(samples)))
+    return staticValues.reindex(columns=[idField] + list(images))
+
+
+# Function to extract the band values for every point and image in a collection. Images are
+# grouped so each request stays under the Earth Engine feature limit which means only a
+# handful of requests are needed instead of one for each image. Output is a long table with
+# the columns pointID, date, imageID followed by the band values.
+def extractCollectionValues(collection, points, scale, numImages, numPoints, idField='pointID'):
+    imagesPerRequest = max(1, MAX_FEATURES_PER_REQUEST // max(1, numPoints))
+    imageList = collection.toList(numImages)
+    tables = []
+    for start in range(0, numImages, imagesPerRequest):
+        chunk = ee.ImageCollection(imageList.slice(start, start + imagesPerRequest))
+        samples = sampleCollection(chunk, points, scale, idField)
+        tables.append(pd.DataFrame(retryEE(lambda: getValues(samples))))
+    if (len(tables) == 0):
+        return pd.DataFrame(columns=[idField, 'date', 'imageID'])
+    pointValues = pd.concat(tables, ignore_index=True)
+    bandColumns = [c for c in pointValues.columns if c not in (idField, 'date', 'imageID')]
+    return pointValues[[idField, 'date', 'imageID'] + bandColumns]
+
+
+# Function to extract only the images that are not yet in a point store. The system:index of
+# the images in the store are compared with the images in the collection and the missing
+# images are extracted in batches of batchSize images. Each batch is saved to the store as soon
+# as it's extracted so if the run is interrupted it can be restarted without losing the
+# batches that were already saved. Output is the list of system:index values that were added.
+def extractNewImages(collection, collectionMetadata, points, scale, numPoints, storeDir, 
+                     batchSize=20, idField='pointID'):
+    storedIDs = set(readPointValues(storeDir, columns=[], idField=idField)['imageID'])
+    newIDs = [i for i in collectionMetadata['imageIDs'] if i not in storedIDs]
+    for start in range(0, len(newIDs), batchSize):
+        batchIDs = newIDs[start:start + batchSize]
+        batch = collection.filter(ee.Filter.inList('system:index', batchIDs))
+        pointValues = extractCollectionValues(batch, points, scale, len(batchIDs), numPoints, idField)
+        appendPointValues(storeDir, pointValues, idField)
+        print("Saved " + str(start + len(batchIDs)) + " of " + str(len(newIDs)) + 
+              " new images      ", end = "\r")
+    return newIDs
+
+
+# Function to extract the point values one image at a time using a pool of worker threads so
+# several requests are sent to Earth Engine at the same time. maxWorkers limits the number of
+# concurrent requests. Requests that fail with a transient error are retried with exponential
+# backoff and dates that still fail are returned in a list instead of stopping the whole run.
+# Output is a dictionary with the point values for each date and the list of failed dates.
+def extractDatesConcurrently(images, dateList, points, scale, maxWorkers=8, maxRetries=5, 
+                             baseDelay=2.0):
+    def extractDate(index):
+        image = ee.Image(images.get(index))
+        extractedPoints = geemap.extract_values_to_points(points, image, scale=scale)
+        return retryEE(lambda: getValues(extractedPoints), maxRetries, baseDelay)
+
+    values = {}
+    failedDates = []
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        futures = {executor.submit(extractDate, index): index for index in range(len(dateList))}
+        for done, future in enumerate(as_completed(futures)):
+            index = futures[future]
+            try:
+                values[index] = future.result()
+            except Exception as err:
+                print("\nFailed to extract " + dateList[index] + ": " + str(err))
+                failedDates.append(dateList[index])
+            print("Processed " + dateList[index] + ": " + str(len(dateList) - done - 1) + 
+                  " images to go      ", end = "\r")
+    # Return the values in the same order as the image collection
+    return {dateList[index]: values[index] for index in sorted(values)}, failedDates
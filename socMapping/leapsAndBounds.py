@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Branch-and-bound best subset search (leaps and bounds, Furnival and Wilson 1974) for linear
+# regression. The residual sum of squares (RSS) of a regression can only decrease when a
+# feature is added, so the RSS of the regression with all of the features that are still
+# available in a branch of the search tree is a lower bound for the RSS of every subset in that
+# branch. Branches whose bound is worse than the best subsets found so far are skipped. The
+# result is exactly the same as testing every subset, but with 25-40 candidate features only
+# a small fraction of the subsets need to be fitted.
+
+# The search finds the subsets with the lowest RSS for each number of features. The in-sample
+# adjusted R2, AIC and BIC are all calculated from the RSS, so the best subset for any of these
+# criteria is one of them.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import heapq
+import math
+import numpy as np
+from subsetRegression import adjust_r2, selectBest, solveNormal
+
+
+# Function to calculate the RSS of the regression (with intercept) on a subset of features
+# from the centered Gram matrix G = Z'Z, c = Z'y and yy = y'y (y centered)
+def subsetRSS(G, c, yy, subset):
+    if (len(subset) == 0):
+        return yy
+    cols = np.array(subset, dtype=np.intp)
+    beta = solveNormal(G[np.ix_(cols, cols)], c[cols])
+    return max(yy - c[cols] @ beta, 0.0)
+
+
+# Function to calculate a selection criterion from the RSS. 'adjr2' is the in-sample adjusted
+# R2 and 'aic' and 'bic' are the Akaike and Bayesian information criteria multiplied by -1 so
+# that higher values are always better. rss and numFeatures can be arrays.
+def criterionScore(rss, numFeatures, numSamples, ssTot, criterion='adjr2'):
+    if (criterion == 'aic'):
+        return -(numSamples * np.log(np.maximum(rss, 1e-300) / numSamples) + 2 * (numFeatures + 1))
+    if (criterion == 'bic'):
+        return -(numSamples * np.log(np.maximum(rss, 1e-300) / numSamples) +
+                 np.log(numSamples) * (numFeatures + 1))
+    return adjust_r2(1 - rss / ssTot, numSamples, numFeatures)
+
+
+# Function to find the nBest subsets with the lowest RSS for each number of features between
+# minFeat and maxFeat. Output is a dictionary with a list of (RSS, subset) for each number of
+# features, sorted from the lowest RSS. Subsets are tuples of feature indices.
+def leapsAndBounds(x, y, minFeat, maxFeat, nBest=1):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float).ravel()
+    scale = x.std(axis=0)
+    scale[scale == 0] = 1
+    Z = (x - x.mean(axis=0)) / scale
+    yc = y - y.mean()
+    G = Z.T @ Z
+    c = Z.T @ yc
+    yy = yc @ yc
+    numFeatures = x.shape[1]
+    maxFeat = min(maxFeat, numFeatures)
+
+    # Order the features from the most to the least important (the increase in RSS when the
+    # feature is removed from the full regression) so good subsets are found early and the
+    # branches with the least important features are pruned
+    fullRSS = subsetRSS(G, c, yy, tuple(range(numFeatures)))
+    importance = [subsetRSS(G, c, yy, tuple(j for j in range(numFeatures) if j != i)) - fullRSS
+                  for i in range(numFeatures)]
+    if (max(importance) <= 1e-12 * max(yy, 1)):
+        importance = list(np.abs(c) / np.sqrt(np.maximum(np.diag(G), 1e-300)))
+    order = sorted(range(numFeatures), key=lambda i: -importance[i])
+
+    # For each number of features keep a heap with the nBest lowest RSS (stored as -RSS)
+    best = {k: [] for k in range(minFeat, maxFeat + 1)}
+
+    def worstRSS(k):
+        return -best[k][0][0] if len(best[k]) == nBest else math.inf
+
+    def canImprove(bound, numChosen, numAvailable):
+        sizes = range(max(minFeat, numChosen), min(maxFeat, numAvailable) + 1)
+        return any(bound < worstRSS(k) for k in sizes)
+
+    def search(chosen, start):
+        if (minFeat <= len(chosen) <= maxFeat):
+            subset = tuple(sorted(order[i] for i in chosen))
+            rss = subsetRSS(G, c, yy, subset)
+            entry = (-rss, subset)
+            heap = best[len(chosen)]
+            if (len(heap) < nBest):
+                heapq.heappush(heap, entry)
+            elif (rss < -heap[0][0]):
+                heapq.heapreplace(heap, entry)
+        if (len(chosen) == maxFeat):
+            return
+        for i in range(start, numFeatures):
+            # The branch with feature i can only use features i and later. The bound gets
+            # larger as i increases so once a branch is pruned all the later ones are too.
+            available = chosen + tuple(range(i, numFeatures))
+            bound = subsetRSS(G, c, yy, tuple(order[j] for j in available))
+            if (not canImprove(bound, len(chosen) + 1, len(available))):
+                break
+            search(chosen + (i,), i + 1)
+
+    search((), 0)
+    return {k: sorted((-negRSS, subset) for negRSS, subset in heap) for k, heap in best.items()}
+
+
+# Function to rank the subsets found by leapsAndBounds with a criterion ('adjr2', 'aic' or
+# 'bic'). Output is the list of subsets and their scores sorted from the best score.
+def rankSubsets(bestBySize, numSamples, ssTot, criterion='adjr2'):
+    ranked = [(subset, criterionScore(rss, len(subset), numSamples, ssTot, criterion))
+              for k in sorted(bestBySize) for rss, subset in bestBySize[k]]
+    ranked.sort(key=lambda item: (-item[1], len(item[0])))
+    return [subset for subset, score in ranked], np.array([score for subset, score in ranked])
+
+
+# Function to find the subset of features with the best in-sample criterion (adjusted R2 by
+# default) using the branch-and-bound search. Output is the same as subsetRegression.bestSubset.
+def bestSubsetBnB(x, y, minFeat, maxFeat, criterion='adjr2'):
+    y = np.asarray(y, dtype=float).ravel()
+    ssTot = ((y - y.mean()) ** 2).sum()
+    subsets, scores = rankSubsets(leapsAndBounds(x, y, minFeat, maxFeat), len(y), ssTot, criterion)
+    return subsets[selectBest(subsets, scores)], {'subsets': subsets, 'score': scores}
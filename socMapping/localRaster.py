@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Functions to extract point values from Sentinel-2 scenes and other layers (TWI, CHILI) that
+# are stored on a local disk as GeoTIFF or cloud optimized GeoTIFF (COG) files. This is used
+# by the "StockSOC_ExtractPoints" script as an alternative to Google Earth Engine. The pixel
+# row and column for all of the points is calculated at once and only the raster blocks that
+# contain points are read.
+
+# The same files are used by "stockSOC_PredictImage" to predict SOC for every pixel without
+# Earth Engine (predictRaster). The output is processed one tile at a time with a pool of
+# processes so memory use doesn't depend on the size of the area.
+
+# Each Sentinel-2 scene is a multi-band file with the acquisition date in the file name
+# (for example S2_2021_04_15.tif or S2_20210415.tif). The band names are read from the band
+# descriptions or can be entered as a list. Cloud and shadow pixels should be set to the
+# nodata value (or masked) in the scene files.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import glob
+import os
+import re
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, from_bounds
+from spectralIndices import calcIndices
+from modelBands import resolveModelBands
+from runConfig import processPool
+
+
+# Regular expression to find the date in a scene file name
+DATE_PATTERN = re.compile(r'(\d{4})[_-]?(\d{2})[_-]?(\d{2})')
+
+# Value used for pixels without a prediction in the output images
+PREDICTION_NODATA = -9999.0
+
+# Rasters opened by each prediction process, so each file is only opened once per process
+openRasters = {}
+
+
+# Function to find the scene files and their dates. Output is a list of (date, imageID, path)
+# sorted by date where the date is formatted as 'YYYY_MM_DD' and imageID is the file name
+# without the extension. Only scenes between startDate and endDate (datetime) and in the
+# months from startMonth to endMonth are returned.
+def findScenes(pattern, startDate=None, endDate=None, startMonth=1, endMonth=12):
+    scenes = []
+    for path in sorted(glob.glob(pattern)):
+        imageID = os.path.splitext(os.path.basename(path))[0]
+        match = DATE_PATTERN.search(imageID)
+        if (match is None):
+            continue
+        year, month, day = (int(g) for g in match.groups())
+        date = '{:04d}_{:02d}_{:02d}'.format(year, month, day)
+        if (startDate is not None and date < startDate.strftime('%Y_%m_%d')):
+            continue
+        if (endDate is not None and date > endDate.strftime('%Y_%m_%d')):
+            continue
+        if (month < startMonth or month > endMonth):
+            continue
+        scenes.append((date, imageID, path))
+    return sorted(scenes)
+
+
+# Function to create the same metadata as the Earth Engine collection metadata for a list
+# of local scenes
+def sceneMetadata(scenes):
+    return {
+        'size': len(scenes),
+        'dates': [s[0] for s in scenes],
+        'imageIDs': [s[1] for s in scenes],
+        'paths': [s[2] for s in scenes]}
+
+
+# Function to calculate the pixel row and column in a raster for arrays of x and y coordinates
+def pointPixels(transform, xs, ys):
+    inverse = ~transform
+    cols = np.floor(inverse.a * xs + inverse.b * ys + inverse.c).astype(np.int64)
+    rows = np.floor(inverse.d * xs + inverse.e * ys + inverse.f).astype(np.int64)
+    return rows, cols
+
+
+# Function to read the values of all bands in a raster at the point locations. Points are
+# grouped by the raster block they fall in and only those blocks are read. Points outside
+# the raster or on masked (nodata) pixels get NaN. Output is an array (points x bands) and
+# the band names.
+def sampleRaster(path, points, bandNames=None):
+    with rasterio.open(path) as src:
+        locations = points.geometry.to_crs(src.crs) if src.crs else points.geometry
+        rows, cols = pointPixels(src.transform, locations.x.to_numpy(), locations.y.to_numpy())
+        values = np.full((len(points), src.count), np.nan)
+        inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+
+        blockHeight, blockWidth = src.block_shapes[0]
+        blockCols = -(-src.width // blockWidth)
+        blockIDs = (rows // blockHeight) * blockCols + cols // blockWidth
+        for block in np.unique(blockIDs[inside]):
+            selected = inside & (blockIDs == block)
+            rowOff = (block // blockCols) * blockHeight
+            colOff = (block % blockCols) * blockWidth
+            window = Window(colOff, rowOff, min(blockWidth, src.width - colOff),
+                            min(blockHeight, src.height - rowOff))
+            data = src.read(window=window, masked=True)
+            blockValues = data[:, rows[selected] - rowOff, cols[selected] - colOff]
+            values[selected] = blockValues.astype(float).filled(np.nan).T
+
+        if (bandNames is None):
+            bandNames = [d if d else 'band' + str(i + 1) for i, d in enumerate(src.descriptions)]
+    return values, list(bandNames)
+
+
+# Function to extract the band values for every point and scene. Scenes with an imageID in
+# skipIDs are not read. Output is the same long table as the Earth Engine extraction with the
+# columns pointID, date, imageID followed by the band values.
+def extractSceneValues(points, scenes, bandNames=None, idField='pointID', skipIDs=()):
+    tables = []
+    for index, (date, imageID, path) in enumerate(scenes):
+        if (imageID in skipIDs):
+            continue
+        print("Processing " + date + ": " + str(len(scenes) - index - 1) + " images to go      ",
+              end = "\r")
+        values, names = sampleRaster(path, points, bandNames)
+        table = pd.DataFrame(values, columns=names)
+        table.insert(0, idField, points[idField].to_numpy())
+        table.insert(1, 'date', date)
+        table.insert(2, 'imageID', imageID)
+        tables.append(table)
+    if (len(tables) == 0):
+        return pd.DataFrame(columns=[idField, 'date', 'imageID'])
+    return pd.concat(tables, ignore_index=True)
+
+
+# Function to extract the first band of single-layer rasters (TWI, CHILI, etc.) at the point
+# locations. rasters is a dictionary with the output column name and the raster path. Output
+# is a table with the point ID and a column for each raster.
+def extractStaticValues(points, rasters, idField='pointID'):
+    table = pd.DataFrame({idField: points[idField].to_numpy()})
+    for name, path in rasters.items():
+        values, _ = sampleRaster(path, points)
+        table[name] = values[:, 0]
+    return table
+
+
+# Function to get the band names of a raster from the band descriptions
+def rasterBandNames(src):
+    return [d if d else 'band' + str(i + 1) for i, d in enumerate(src.descriptions)]
+
+
+# Function to open a raster in a prediction process. Rasters in the static dictionary (TWI,
+# CHILI, etc.) are warped on the fly to the grid of the scene so the tiles line up. Nearest
+# neighbour resampling is used so the values are the same as the point values the model was
+# fitted with (sampleRaster and Earth Engine both use the pixel that contains the point).
+def openPredictionRaster(path, grid=None):
+    key = (path, grid)
+    if (key not in openRasters):
+        src = rasterio.open(path)
+        if (grid is not None):
+            crs, transform, width, height = grid
+            src = WarpedVRT(src, crs=crs, transform=transform, width=width, height=height,
+                            resampling=Resampling.nearest)
+        openRasters[key] = src
+    return openRasters[key]
+
+
+# Function to close the rasters opened by openPredictionRaster in this process
+def closePredictionRasters():
+    for src in openRasters.values():
+        if (isinstance(src, WarpedVRT)):
+            src.close()
+            src = src.src_dataset
+        src.close()
+    openRasters.clear()
+
+
+# Function to calculate the prediction for one tile. task is a tuple with the tile window, the
+# scene path, the scene band names, a dictionary of static rasters, the scene grid, the model
+# (intercept, coefficients and the band for each coefficient) and the model's X'X inverse and
+# residual variance (None to skip the standard error). Output is the window and an array with
+# the predicted values and, if xtxInv is given, the standard error of the prediction
+# sqrt(sigma2 * x'(X'X)^-1 x), with PREDICTION_NODATA where any input is masked.
+def predictTile(task):
+    window, scenePath, sceneBands, staticRasters, grid, intercept, coef, bands, xtxInv, sigma2 = task
+    scene = openPredictionRaster(scenePath)
+    shape = (int(window.height), int(window.width))
+    rawBands, indexNames, staticNames = resolveModelBands(bands, staticRasters)
+
+    # Read only the scene bands that are needed, as one array
+    values = {}
+    valid = np.ones(shape, dtype=bool)
+    if (len(rawBands) > 0):
+        data = scene.read([sceneBands.index(b) + 1 for b in rawBands], window=window, masked=True)
+        valid &= ~np.ma.getmaskarray(data).any(axis=0)
+        data = data.filled(0).astype(np.float64)
+        values.update(zip(rawBands, data))
+        if (len(indexNames) > 0):
+            values.update(zip(indexNames, calcIndices(data, rawBands, indexNames, bandAxis=0)))
+    for name in staticNames:
+        static = openPredictionRaster(staticRasters[name], grid).read(1, window=window, masked=True)
+        valid &= ~np.ma.getmaskarray(static)
+        values[name] = static.filled(0).astype(np.float64)
+
+    prediction = np.full(shape, float(intercept))
+    for c, name in zip(coef, bands):
+        prediction += c * values[name]
+    output = [prediction]
+    if (xtxInv is not None):
+        design = np.stack([np.ones(shape)] + [values[name] for name in bands])
+        variance = sigma2 * np.einsum('ihw,ij,jhw->hw', design, np.asarray(xtxInv), design, optimize=True)
+        output.append(np.sqrt(np.maximum(variance, 0)))
+    output = np.stack(output)
+    valid &= np.isfinite(output).all(axis=0)
+    return window, np.where(valid, output, PREDICTION_NODATA).astype(np.float32)
+
+
+# Function to list the tile windows that cover a window of a raster
+def tileWindows(window, tileSize):
+    rowOff, colOff = int(window.row_off), int(window.col_off)
+    height, width = int(window.height), int(window.width)
+    return [Window(c, r, min(tileSize, colOff + width - c), min(tileSize, rowOff + height - r))
+            for r in range(rowOff, rowOff + height, tileSize)
+            for c in range(colOff, colOff + width, tileSize)]
+
+
+# Function to predict SOC for every pixel of a local Sentinel-2 scene with a linear model
+# (intercept, coefficients and the band or index for each coefficient). staticRasters is a
+# dictionary with the name and path of other layers used by the model (for example
+# {'twi': path, 'chili': path}). If a boundary (GeoDataFrame) is given only the area inside
+# its extent is predicted. The output is a tiled, compressed float32 GeoTIFF and,
+# if cogPath is given, a cloud optimized GeoTIFF copy. If the model's X'X inverse (intercept
+# first) and residual variance are given, the standard error of the prediction is calculated in
+# the same pass over the tiles and written as a second band.
+def predictRaster(scenePath, outPath, intercept, coef, bands, staticRasters=None, sceneBandNames=None,
+                  boundary=None, tileSize=512, numWorkers=None, cogPath=None, xtxInv=None, sigma2=None):
+    staticRasters = {name: path for name, path in (staticRasters or {}).items() if path}
+    with rasterio.open(scenePath) as src:
+        sceneBands = list(sceneBandNames) if sceneBandNames else rasterBandNames(src)
+        fullWindow = Window(0, 0, src.width, src.height)
+        if (boundary is None):
+            window = fullWindow
+        else:
+            bounds = boundary.to_crs(src.crs).total_bounds if src.crs else boundary.total_bounds
+            window = from_bounds(*bounds, transform=src.transform).round_offsets().round_lengths()
+            window = window.intersection(fullWindow)
+        grid = (src.crs, src.transform, src.width, src.height)
+        profile = src.profile.copy()
+
+    for name in resolveModelBands(bands, staticRasters)[0]:
+        if (name not in sceneBands):
+            raise ValueError('Band ' + name + ' used by the model is not in the scene')
+
+    # The output covers only the predicted window, with tiles counted from its corner
+    outTransform = rasterio.windows.transform(window, grid[1])
+    bandDescriptions = ['prediction'] if xtxInv is None else ['prediction', 'standard_error']
+    profile.update(driver='GTiff', count=len(bandDescriptions), dtype='float32', nodata=PREDICTION_NODATA,
+                   width=int(window.width), height=int(window.height), transform=outTransform,
+                   tiled=True, blockxsize=256, blockysize=256, compress='deflate', predictor=3,
+                   BIGTIFF='IF_SAFER')
+    tasks = [(tile, scenePath, sceneBands, staticRasters, grid, intercept, list(coef), list(bands),
+              xtxInv, sigma2) for tile in tileWindows(window, tileSize)]
+
+    with rasterio.open(outPath, 'w', **profile) as dst:
+        for i, description in enumerate(bandDescriptions):
+            dst.set_band_description(i + 1, description)
+        # The worker processes are stopped and the rasters opened in this process (with one
+        # worker) are closed even if a tile fails
+        executor = processPool(numWorkers)
+        try:
+            if (executor is None):
+                results = map(predictTile, tasks)
+            else:
+                results = executor.map(predictTile, tasks)
+            for index, (tile, prediction) in enumerate(results):
+                print("Predicted tile " + str(index + 1) + " of " + str(len(tasks)) + "      ", end = "\r")
+                dst.write(prediction, window=Window(tile.col_off - window.col_off,
+                                                       tile.row_off - window.row_off,
+                                                       tile.width, tile.height))
+        finally:
+            if (executor is not None):
+                executor.shutdown(cancel_futures=True)
+            closePredictionRasters()
+
+    if (cogPath):
+        rasterio.shutil.copy(outPath, cogPath, driver='COG', compress='deflate', predictor=3)
+    return outPath
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Functions to calculate leave-one-out (LOO) cross validation metrics for linear regression
+# without fitting the regression once for every sample. For ordinary least squares the LOO
+# residual for sample i is e_i / (1 - h_i), where e_i is the residual from the regression fit
+# with all samples and h_i is the leverage (diagonal of the hat matrix). The sum of the
+# squared LOO residuals is the PRESS statistic. These give exactly the same RMSE as running
+# scikit-learn cross_val_score with LeaveOneOut.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import numpy as np
+from subsetRegression import (designMatrix, subsetColumns, featureSubsets,
+                              selectBest, SUBSET_CHUNK)
+
+
+# Function to invert a stack of Gram matrices, using the pseudo-inverse if any is singular
+def invertGram(G):
+    try:
+        return np.linalg.inv(G)
+    except np.linalg.LinAlgError:
+        return np.linalg.pinv(G)
+
+
+# Function to calculate the leave-one-out residuals from a single regression fit. Samples with
+# a leverage of 1 (the regression passes through the point no matter what) get NaN.
+def looResiduals(x, y):
+    X = designMatrix(x)
+    y = np.asarray(y, dtype=float).ravel()
+    Ginv = invertGram(X.T @ X)
+    residuals = y - X @ (Ginv @ (X.T @ y))
+    leverage = np.einsum('ij,jk,ik->i', X, Ginv, X)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(leverage < 1 - 1e-10, residuals / (1 - leverage), np.nan)
+
+
+# Function to calculate the leave-one-out RMSE, normalized RMSE (RMSE / mean of y) and
+# predicted R2 (1 - PRESS / total sum of squares)
+def looMetrics(x, y):
+    y = np.asarray(y, dtype=float).ravel()
+    press = (looResiduals(x, y) ** 2).sum()
+    RMSE = np.sqrt(press / len(y))
+    NRMSE = RMSE / y.mean()
+    predictedR2 = 1 - press / ((y - y.mean()) ** 2).sum()
+    return RMSE, NRMSE, predictedR2
+
+
+# Function to calculate the leave-one-out predicted R2 for each subset of features. All
+# subsets with the same number of features are calculated together from the Gram matrix.
+def looSubsetScores(x, y, subsets):
+    X = designMatrix(x)
+    y = np.asarray(y, dtype=float).ravel()
+    G = X.T @ X
+    c = X.T @ y
+    ssTot = ((y - y.mean()) ** 2).sum()
+
+    scores = np.zeros(len(subsets))
+    sizes = np.array([len(s) for s in subsets])
+    for k in np.unique(sizes):
+        groupIndex = np.flatnonzero(sizes == k)
+        for start in range(0, len(groupIndex), SUBSET_CHUNK):
+            chunk = groupIndex[start:start + SUBSET_CHUNK]
+            cols = subsetColumns([subsets[i] for i in chunk])
+            Ginv = invertGram(G[cols[:, :, None], cols[:, None, :]])
+            beta = np.einsum('mjl,ml->mj', Ginv, c[cols])
+            Xs = X[:, cols]
+            residuals = y[None, :] - np.einsum('nmj,mj->mn', Xs, beta)
+            leverage = np.einsum('nmj,mjl,nml->mn', Xs, Ginv, Xs)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                press = ((residuals / (1 - leverage)) ** 2).sum(axis=1)
+            scores[chunk] = np.where(np.isfinite(press), 1 - press / ssTot, -np.inf)
+    return scores
+
+
+# Function to find the subset of features with the highest leave-one-out predicted R2. Output
+# is the same as subsetRegression.bestSubset.
+def bestSubsetLOO(x, y, minFeat, maxFeat):
+    subsets = featureSubsets(np.shape(x)[1], minFeat, maxFeat)
+    scores = looSubsetScores(x, y, subsets)
+    return subsets[selectBest(subsets, scores)], {'subsets': subsets, 'loo_score': scores}
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Functions to build only the bands a regression model needs. A model uses a list of bands
+# that can be Sentinel-2 bands, spectral indices (spectralIndices.py) or covariates such as
+# TWI and CHILI. The list is resolved into the raw bands, indices and covariates that are
+# needed so nothing else is calculated or downloaded, and the prediction expression is built
+# for any number of coefficients. Predictions for many dates (the models in the
+# "StockSOC_ProcessPoints" results file) can be built from one masked image collection.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import os
+from datetime import datetime, timedelta, timezone
+from eeCache import getInfo
+from spectralIndices import SPECTRAL_INDICES, addIndexBands, indexBands
+
+
+# Function to find what is needed to calculate the model bands. covariateNames are the names
+# of the covariates that are available. Output is the list of raw bands (including the bands
+# used by the indices), the list of indices and the list of covariates.
+def resolveModelBands(bands, covariateNames=()):
+    rawBands = []
+    indexNames = []
+    covariates = []
+    for name in bands:
+        if (name in covariateNames):
+            covariates.append(name)
+        elif (name in SPECTRAL_INDICES):
+            indexNames.append(name)
+        else:
+            rawBands.append(name)
+    for band in indexBands(indexNames):
+        if (band not in rawBands):
+            rawBands.append(band)
+    return rawBands, indexNames, covariates
+
+
+# Function to build an Earth Engine image with the model bands (in the same order) from a
+# Sentinel-2 image. covariates is a dictionary with the covariate name and either an ee.Image
+# or a function that returns the ee.Image, so covariates the model doesn't use aren't created.
+def modelImage(sceneImage, bands, covariates=None):
+    covariates = covariates or {}
+    rawBands, indexNames, covariateNames = resolveModelBands(bands, covariates)
+    img = addIndexBands(sceneImage.select(rawBands), indexNames)
+    for name in covariateNames:
+        covariate = covariates[name]() if callable(covariates[name]) else covariates[name]
+        img = img.addBands(covariate.rename(name))
+    return img.select(list(bands))
+
+
+# Function to create the prediction expression for a linear model with any number of
+# coefficients. The band for coefficient i is called b1, b2, ...
+def predictionExpression(intercept, coef):
+    return str(intercept) + ''.join(' + (' + str(c) + ' * b' + str(i + 1) + ')'
+                                    for i, c in enumerate(coef))
+
+
+# Function to calculate the prediction image from an image with the model bands
+def predictImage(image, intercept, coef, bands):
+    variables = {'b' + str(i + 1): image.select(band) for i, band in enumerate(bands)}
+    return image.expression(predictionExpression(intercept, coef), variables).rename('prediction')
+
+
+# Function to create the expression for the variance of the prediction, sigma2 * x'(X'X)^-1 x,
+# where x is 1 (intercept) followed by the model bands b1, b2, ...
+def varianceExpression(xtxInv, sigma2):
+    terms = []
+    for i in range(len(xtxInv)):
+        for j in range(i, len(xtxInv)):
+            factor = float(xtxInv[i][j]) * (1 if i == j else 2)
+            terms.append('(' + str(factor) + ')' + ''.join(' * b' + str(k) for k in (i, j) if k > 0))
+    return str(sigma2) + ' * (' + ' + '.join(terms) + ')'
+
+
+# Function to calculate the standard error of the prediction for every pixel from an image with
+# the model bands, the model's X'X inverse (intercept first) and the residual variance
+def standardErrorImage(image, xtxInv, sigma2, bands):
+    variables = {'b' + str(i + 1): image.select(band) for i, band in enumerate(bands)}
+    return image.expression(varianceExpression(xtxInv, sigma2), variables).max(0).sqrt() \
+        .rename('standard_error')
+
+
+# Function to get the dates (YYYY_MM_DD) of the images in an image collection with one request
+def collectionDates(collection):
+    return set(datetime.fromtimestamp(t / 1000, timezone.utc).strftime('%Y_%m_%d')
+               for t in getInfo(collection.aggregate_array('system:time_start')))
+
+
+# Function to create the prediction images for a list of models (see resultsWriter.readModels)
+# from one masked Sentinel-2 image collection. The covariates are only created once and are
+# shared by all of the dates. Dates that don't have an image in the collection are skipped.
+# Output is a dictionary with the date and the prediction image named pred_YYYY_MM_DD. If
+# standardError is True and the models have the X'X inverse, each image also has the standard
+# error band se_YYYY_MM_DD.
+def batchPredictionImages(collection, models, covariates=None, standardError=False):
+    covariates = covariates or {}
+    imageDates = collectionDates(collection)
+    usedNames = set(name for model in models for name in model['BestFeatures'])
+    shared = {name: (covariate() if callable(covariate) else covariate)
+              for name, covariate in covariates.items() if name in usedNames}
+    images = {}
+    for model in models:
+        if (model['Date'] not in imageDates):
+            print('No image for ' + model['Date'] + ' in the image collection, skipping it')
+            continue
+        start = datetime.strptime(model['Date'], '%Y_%m_%d')
+        end = start + timedelta(days=1)
+        sceneImage = collection.filterDate(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')).first()
+        image = modelImage(sceneImage, model['BestFeatures'], shared)
+        prediction = predictImage(image, model['Intercept'], model['Coefficients'], model['BestFeatures']) \
+            .rename('pred_' + model['Date'])
+        if (standardError and 'XtXInv' in model):
+            prediction = prediction.addBands(standardErrorImage(image, model['XtXInv'], model['Sigma2'],
+                                                                model['BestFeatures']).rename('se_' + model['Date']))
+        images[model['Date']] = prediction
+    return images
+
+
+# Function to add the date to an output file name (image.tif to image_YYYY_MM_DD.tif)
+def datedFileName(path, date):
+    root, extension = os.path.splitext(path)
+    return root + '_' + date + extension
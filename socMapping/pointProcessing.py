@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Functions used by the "StockSOC_ProcessPoints" script to find the best linear regression for
+# each date using a pool of processes so several dates are processed at the same time. Only
+# the feature and target arrays for each date are sent to the worker processes, not the
+# point tables, and the results are returned in date order as soon as they are available.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import math
+import numpy as np
+from sklearn import linear_model
+from subsetRegression import bestSubset, featureSubsets, selectBest
+from looMetrics import looMetrics, bestSubsetLOO
+from batchSubsets import bestSubsetsAllDates
+from leapsAndBounds import bestSubsetBnB
+from subsetScreening import bestSubsetScreened, selectionScores
+from scoreCache import scoreCacheFile
+from bootstrap import bootstrapIntervals
+from runConfig import processPool
+
+
+# Function to find the best subset of features by testing every subset with the selection
+# criterion in the settings. If cacheFile is given the subset scores are cached (scoreCache.py).
+def fullSubsetSearch(x, y, featureNames, settings, cacheFile=None):
+    if (cacheFile):
+        subsets = featureSubsets(x.shape[1], settings['min_feat'], settings['max_feat'])
+        scores = selectionScores(x, y, subsets, settings['selectionCriterion'],
+                                 math.floor(len(y) / 2), cacheFile, featureNames)
+        return subsets[selectBest(subsets, scores)]
+    if (settings['selectionCriterion'] == 'loo'):
+        best_idx, subsetScores = bestSubsetLOO(x, y, settings['min_feat'], settings['max_feat'])
+    else:
+        best_idx, subsetScores = bestSubset(x, y, settings['min_feat'], settings['max_feat'],
+                                            math.floor(len(y) / 2))
+    return best_idx
+
+
+# Function to get the score cache file for a date, or None if the cache isn't used. The file
+# depends on the data, the target variable and the cross validation scheme.
+def dateCacheFile(key, x, y, featureNames, settings):
+    if (not settings.get('scoreCacheDir')):
+        return None
+    if (settings['selectionCriterion'] == 'loo'):
+        scheme = 'loo'
+    else:
+        scheme = 'kfold' + str(math.floor(len(y) / 2))
+    return scoreCacheFile(settings['scoreCacheDir'], key, x, y, featureNames,
+                          settings.get('target', ''), scheme)
+
+
+# Function to find the best subset of features for one date, fit the regression with those
+# features and calculate the metrics. task is a tuple with the date, the feature array
+# (points x features), the values to predict, the feature names and a dictionary of settings
+# (min_feat, max_feat, selectionCriterion, subsetSearch, screenTopK, screenCriterion,
+# auditScreening, scoreCacheDir, target, nBootstrap, bootstrapConfidence). If the settings include best_idx, the best subset was
+# already found (see batchSubsets.py) and the search is skipped.
+def processDate(task):
+    key, x, y, featureNames, settings = task
+    cacheFile = dateCacheFile(key, x, y, featureNames, settings)
+    screeningChanged = None
+    if (settings.get('best_idx') is not None):
+        best_idx = settings['best_idx']
+    elif (settings.get('screenTopK')):
+        best_idx, subsetScores = bestSubsetScreened(x, y, settings['min_feat'], settings['max_feat'],
+                                                    math.floor(len(y) / 2), settings['screenTopK'],
+                                                    settings.get('screenCriterion', 'adjr2'),
+                                                    settings['selectionCriterion'],
+                                                    settings.get('subsetSearch') == 'branchAndBound',
+                                                    cacheFile, featureNames)
+        # Check if testing every subset selects a different subset
+        if (settings.get('auditScreening')):
+            fullBest = fullSubsetSearch(x, y, featureNames, settings, cacheFile)
+            screeningChanged = tuple(best_idx) != tuple(fullBest)
+    elif (settings.get('subsetSearch') == 'branchAndBound'):
+        # The branch-and-bound search uses bounds on the residual sum of squares, which only hold
+        # for in-sample criteria, so the subset is selected with screenCriterion (adjr2, aic or bic)
+        # instead of the cross validated selectionCriterion
+        best_idx, subsetScores = bestSubsetBnB(x, y, settings['min_feat'], settings['max_feat'],
+                                               settings.get('screenCriterion', 'adjr2'))
+    else:
+        best_idx = fullSubsetSearch(x, y, featureNames, settings, cacheFile)
+    best_feature_names = tuple(featureNames[i] for i in best_idx)
+
+    # Get the R2 Adjusted R2, RMSE and Normalize RMSE for the variables with the best fit
+    xBest = x[:, list(best_idx)]
+    fitTOC = linear_model.LinearRegression().fit(xBest, y)
+    R2TOC = fitTOC.score(xBest, y)
+    Adjusted_R2 = 1 - (1 - R2TOC) * (len(y) - 1) / (len(y) - xBest.shape[1] - 1)
+    RMSE, NRMSE, Predicted_R2 = looMetrics(xBest, y)
+    result = {'Date': key, 'R2': R2TOC, 'Adjusted_R2': Adjusted_R2, 'RMSE': RMSE, 'NRMSE': NRMSE,
+              'Predicted_R2': Predicted_R2, 'BestFeatures': best_feature_names,
+              'Intercept': fitTOC.intercept_, 'Coefficients': fitTOC.coef_}
+    # Add the residual variance and (X'X)^-1 (intercept first) so the standard error of the
+    # prediction, sqrt(Sigma2 * x'(X'X)^-1 x), can be calculated for every pixel
+    X = np.hstack([np.ones((len(y), 1)), xBest])
+    residuals = y - fitTOC.predict(xBest)
+    result['Sigma2'] = residuals @ residuals / max(len(y) - X.shape[1], 1)
+    result['XtXInv'] = np.linalg.pinv(X.T @ X)
+    if (screeningChanged is not None):
+        result['ScreeningChanged'] = screeningChanged
+    # Add bootstrap confidence intervals for the coefficients, R2 and RMSE
+    if (settings.get('nBootstrap')):
+        result.update(bootstrapIntervals(xBest, y, settings['nBootstrap'],
+                                         settings.get('bootstrapConfidence', 0.95)))
+    return result
+
+
+# Function to process the dates using numWorkers processes. The results are returned one at a
+# time in the same order as the tasks. With one worker the dates are processed in this process.
+def processDates(tasks, numWorkers=None):
+    pool = processPool(numWorkers)
+    if (pool is None):
+        for task in tasks:
+            yield processDate(task)
+        return
+    with pool as executor:
+        for result in executor.map(processDate, tasks):
+            yield result
+
+
+# Function to find the best subset of features for all of the dates at once with the batched
+# NumPy calculation in batchSubsets.py. Dates with the same features are stacked together.
+# Output is the list of tasks with the best subset added to the settings for each date.
+def addBatchedBestSubsets(tasks):
+    groups = {}
+    for index, task in enumerate(tasks):
+        groups.setdefault(tuple(task[3]), []).append(index)
+    tasks = list(tasks)
+    for indices in groups.values():
+        settings = tasks[indices[0]][4]
+        bestSubsets = bestSubsetsAllDates([tasks[i][1] for i in indices], [tasks[i][2] for i in indices],
+                                          settings['min_feat'], settings['max_feat'],
+                                          settings['selectionCriterion'])
+        for i, best_idx in zip(indices, bestSubsets):
+            key, x, y, featureNames, settings = tasks[i]
+            tasks[i] = (key, x, y, featureNames, dict(settings, best_idx=best_idx))
+    return tasks
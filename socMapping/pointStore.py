@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Functions to save and read the point data extracted by the "StockSOC_ExtractPoints" script
+# in a columnar (Parquet) format. The point store is a directory with two parts:
+#   samples.parquet  - the attributes for each sample point (SOC, BD, stock, etc.) stored once
+#   values/          - Parquet files with the band values in a long table with one row
+#                      for each point and image date (pointID, date, imageID, bands)
+# The values can be read for selected dates and columns without loading the whole store.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import hashlib
+import json
+import os
+import re
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+# Regular expression to identify the Sentinel-2 band columns (B1-B12, B8A)
+BAND_PATTERN = re.compile(r'^B\d+A?$')
+
+
+# Function to get the band columns in a table of point data
+def bandColumns(points):
+    return [c for c in points.columns if BAND_PATTERN.match(str(c))]
+
+
+# Function to split the long table of point values into a dictionary with one table for each
+# date, each joined to the point attributes (SOC, BD, etc.). This is the same structure that
+# was created by extracting one image at a time. If more than one image was acquired on the
+# same date the last one is used. Dates where all of the points are masked are skipped.
+def dateFrames(pointValues, pointAttributes, idField='pointID', checkBand='B3'):
+    frames = {}
+    for date, values in pointValues.groupby('date', sort=True):
+        values = values[values['imageID'] == values['imageID'].iloc[-1]]
+        values = values.drop(columns=['date', 'imageID']).dropna(axis=1, how='all')
+        if (checkBand not in values):
+            continue
+        frames[date] = pointAttributes.merge(values, on=idField, how='left')
+    return frames
+
+
+# Function to convert a dictionary with a table of points for each date into the point
+# attributes table and the long table of band values. imageIDs is a dictionary with the
+# system:index of the image for each date.
+def splitDateFrames(extractedValues, imageIDs, idField='pointID'):
+    attributes = []
+    values = []
+    for date, points in extractedValues.items():
+        bands = bandColumns(points)
+        attributes.append(points.drop(columns=bands))
+        dateValues = points[[idField] + bands].copy()
+        dateValues.insert(1, 'date', date)
+        dateValues.insert(2, 'imageID', imageIDs.get(date, date))
+        values.append(dateValues)
+    pointAttributes = pd.concat(attributes, ignore_index=True).drop_duplicates(idField)
+    pointValues = pd.concat(values, ignore_index=True)
+    return pointAttributes.reset_index(drop=True), pointValues
+
+
+# Function to write the long table of point values as a new Parquet file in the store. Band
+# values are saved as 32-bit floats which holds the Sentinel-2 DN values exactly.
+def appendPointValues(storeDir, pointValues, idField='pointID'):
+    valuesDir = os.path.join(storeDir, 'values')
+    os.makedirs(valuesDir, exist_ok=True)
+    pointValues = pointValues.astype({b: 'float32' for b in bandColumns(pointValues)})
+    pointValues = pointValues.astype({idField: str, 'date': str, 'imageID': str})
+    partNumber = len([f for f in os.listdir(valuesDir) if f.endswith('.parquet')])
+    partFile = os.path.join(valuesDir, 'part-{:05d}.parquet'.format(partNumber))
+    pq.write_table(pa.Table.from_pandas(pointValues, preserve_index=False), partFile)
+    return partFile
+
+
+# Function to write the point attributes to the store. Existing attributes are replaced.
+def writePointAttributes(storeDir, pointAttributes, idField='pointID'):
+    os.makedirs(storeDir, exist_ok=True)
+    pointAttributes = pointAttributes.astype({idField: str})
+    pq.write_table(pa.Table.from_pandas(pointAttributes, preserve_index=False),
+                   os.path.join(storeDir, 'samples.parquet'))
+
+
+# Function to write a new point store from the dictionary of points for each date. Nothing is
+# written if there are no dates (for example when every image had too many clouds).
+def writePointStore(storeDir, extractedValues, imageIDs, idField='pointID'):
+    if (len(extractedValues) == 0):
+        print('No point values were extracted so the point store ' + storeDir + ' was not written')
+        return
+    pointAttributes, pointValues = splitDateFrames(extractedValues, imageIDs, idField)
+    writePointAttributes(storeDir, pointAttributes, idField)
+    valuesDir = os.path.join(storeDir, 'values')
+    if (os.path.isdir(valuesDir)):
+        for f in os.listdir(valuesDir):
+            if (f.endswith('.parquet')):
+                os.remove(os.path.join(valuesDir, f))
+    appendPointValues(storeDir, pointValues, idField)
+
+
+# Function to read the point attributes from the store
+def readPointAttributes(storeDir):
+    return pq.read_table(os.path.join(storeDir, 'samples.parquet'), memory_map=True).to_pandas()
+
+
+# Function to read the long table of band values from the store. The files are memory-mapped
+# and only the requested dates and columns (in addition to pointID, date and imageID) are read.
+# The files can have different band columns (for example when images with other bands were
+# appended later) so the dataset uses the columns from all of the files. Bands that aren't in
+# a file are read as missing values.
+def readPointValues(storeDir, dates=None, columns=None, idField='pointID'):
+    valuesDir = os.path.join(storeDir, 'values')
+    partFiles = []
+    if (os.path.isdir(valuesDir)):
+        partFiles = sorted(os.path.join(valuesDir, f) for f in os.listdir(valuesDir)
+                           if f.endswith('.parquet'))
+    if (len(partFiles) == 0):
+        return pd.DataFrame(columns=[idField, 'date', 'imageID'])
+    schema = pa.unify_schemas([pq.read_schema(f).remove_metadata() for f in partFiles])
+    dataset = ds.dataset(partFiles, schema=schema, format='parquet',
+                         filesystem=pa.fs.LocalFileSystem(use_mmap=True))
+    if (columns is not None):
+        columns = [idField, 'date', 'imageID'] + [c for c in columns
+                                                  if c not in (idField, 'date', 'imageID')]
+    rowFilter = None
+    if (dates is not None):
+        rowFilter = ds.field('date').isin(list(dates))
+    return dataset.to_table(columns=columns, filter=rowFilter).to_pandas()
+
+
+# Function to read the store into a dictionary with a table of points for each date, the same
+# structure that is written to the pickle file
+def readPointStore(storeDir, dates=None, columns=None, idField='pointID'):
+    return dateFrames(readPointValues(storeDir, dates, columns, idField),
+                      readPointAttributes(storeDir), idField)
+
+
+# Function to create a hash that identifies a set of sample points from the point IDs and
+# coordinates in a GeoDataFrame
+def pointSetHash(points, idField='pointID'):
+    pointSet = {'crs': str(points.crs), 'id': points[idField].astype(str).tolist(),
+                'x': points.geometry.x.round(6).tolist(), 'y': points.geometry.y.round(6).tolist()}
+    return hashlib.sha256(json.dumps(pointSet).encode('utf-8')).hexdigest()
+
+
+# Function to get the static covariates (TWI, CHILI) for the sample points. The values are
+# saved in cacheDir in a file named with a hash of cacheKey, which should identify the point
+# set and the pixel scale. If the file exists the values are read from it and extract (a
+# function that returns a table with the point ID and the covariates) is not called.
+def cachedStaticValues(cacheDir, cacheKey, extract):
+    if (not cacheDir):
+        return extract()
+    keyHash = hashlib.sha256(json.dumps(cacheKey, default=str).encode('utf-8')).hexdigest()
+    cacheFile = os.path.join(cacheDir, 'static_' + keyHash[:32] + '.parquet')
+    if (os.path.exists(cacheFile)):
+        return pq.read_table(cacheFile).to_pandas()
+    staticValues = extract()
+    os.makedirs(cacheDir, exist_ok=True)
+    pq.write_table(pa.Table.from_pandas(staticValues, preserve_index=False), cacheFile)
+    return staticValues
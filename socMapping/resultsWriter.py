@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Functions used by the "StockSOC_ProcessPoints" script to write the regression results for
+# each date to the output CSV file as soon as the date is processed. The intercept,
+# coefficients and feature names are written as separate columns (Intercept, Feature1..N,
+# Coef1..N) so the file can be read back as numbers. If the script is stopped, the dates that
+# are already in the file can be skipped when it is run again with the same settings. The
+# models in the file can be read back (readModels) to predict images for many dates at once in
+# "stockSOC_PredictImage".
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import csv
+import json
+import os
+import re
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+# Metrics written for each date before the regression coefficients
+METRIC_COLUMNS = ['Date', 'R2', 'Adjusted_R2', 'RMSE', 'NRMSE', 'Predicted_R2']
+
+
+# Function to convert the result for one date from pointProcessing.processDate into a row
+# for the output file. maxFeatures is the largest number of features in a regression so every
+# row has the same columns. Other values in the result are added after the coefficients, with
+# arrays (for example the bootstrap coefficient limits) written as one column per feature.
+def resultRow(result, maxFeatures):
+    row = {column: result[column] for column in METRIC_COLUMNS}
+    row['Intercept'] = float(result['Intercept'])
+    features = list(result['BestFeatures'])
+    coefficients = np.ravel(result['Coefficients'])
+    for i in range(maxFeatures):
+        row['Feature' + str(i + 1)] = features[i] if i < len(features) else ''
+    for i in range(maxFeatures):
+        row['Coef' + str(i + 1)] = float(coefficients[i]) if i < len(coefficients) else None
+    for key, value in result.items():
+        if (key in row or key in ('BestFeatures', 'Coefficients')):
+            continue
+        if (np.ndim(value) == 0):
+            row[key] = value
+        elif (np.ndim(value) == 1):
+            for i in range(maxFeatures):
+                row[key + str(i + 1)] = float(value[i]) if i < len(value) else None
+        elif (np.ndim(value) == 2):
+            # Symmetric matrix with the intercept first (X'X inverse): write the upper triangle
+            for i in range(maxFeatures + 1):
+                for j in range(i, maxFeatures + 1):
+                    inside = i < value.shape[0] and j < value.shape[1]
+                    row[key + '_' + str(i) + '_' + str(j)] = float(value[i, j]) if inside else None
+    return row
+
+
+# Function to get the dates that are already in the results file
+def finishedDates(outCSV):
+    if (not os.path.exists(outCSV) or os.path.getsize(outCSV) == 0):
+        return set()
+    return set(pd.read_csv(outCSV, usecols=['Date'], dtype={'Date': str})['Date'])
+
+
+# Function to get the name of the file with the settings used to create a results file
+def settingsFile(outCSV):
+    return os.path.splitext(outCSV)[0] + '_settings.json'
+
+
+# Function to check that the dates in a results file were processed with the same settings
+# before the file is resumed. The settings are saved next to the results file when it is
+# created. If the settings changed a ValueError is raised so old results aren't kept by mistake.
+def checkResumeSettings(outCSV, settings):
+    path = settingsFile(outCSV)
+    settings = json.loads(json.dumps(settings))
+    if (os.path.exists(outCSV) and os.path.getsize(outCSV) > 0):
+        saved = None
+        if (os.path.exists(path)):
+            with open(path, 'r') as f:
+                saved = json.load(f)
+        if (saved != settings):
+            changed = sorted(k for k in set(settings) | set(saved or {})
+                             if (saved or {}).get(k) != settings.get(k))
+            raise ValueError(outCSV + ' was created with different settings (' + ', '.join(changed) +
+                             '). Set resumeResults to False or use a new outCSV.')
+    with open(path, 'w') as f:
+        json.dump(settings, f, indent=2)
+
+
+# Function to rewrite the results file with more columns (for example after max_feat is
+# increased or the bootstrap is turned on). Existing rows get empty values in the new columns.
+def addColumns(outCSV, columns):
+    with open(outCSV, newline='') as f:
+        rows = list(csv.DictReader(f))
+    handle, tmpPath = tempfile.mkstemp(dir=os.path.dirname(outCSV) or '.', suffix='.tmp')
+    with os.fdopen(handle, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmpPath, outCSV)
+
+
+# Function to append one row to the results file. The header is written when the file is
+# created. If the row has columns that aren't in the file, the file is rewritten with all of
+# the columns first so no values are lost.
+def appendResult(outCSV, row):
+    newFile = not os.path.exists(outCSV) or os.path.getsize(outCSV) == 0
+    if (newFile):
+        columns = list(row)
+    else:
+        with open(outCSV, newline='') as f:
+            columns = next(csv.reader(f))
+        newColumns = [column for column in row if column not in columns]
+        if (len(newColumns) > 0):
+            columns = columns + newColumns
+            addColumns(outCSV, columns)
+    with open(outCSV, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        if (newFile):
+            writer.writeheader()
+        writer.writerow(row)
+
+
+# Function to read the regression models from a results file. Only models with an R2 of at
+# least minR2 and an NRMSE no larger than maxNRMSE are returned (None to not filter). Output is
+# a list of dictionaries with the Date, Intercept, Coefficients and BestFeatures for each model
+# plus the other columns in the file. If the file has the X'X inverse it is added as XtXInv.
+def readModels(resultsCSV, minR2=None, maxNRMSE=None):
+    results = pd.read_csv(resultsCSV, dtype={'Date': str})
+    if (minR2 is not None):
+        results = results[results['R2'] >= minR2]
+    if (maxNRMSE is not None):
+        results = results[results['NRMSE'] <= maxNRMSE]
+    numFeatures = len([c for c in results.columns if re.fullmatch(r'Feature\d+', c)])
+    models = []
+    for row in results.to_dict('records'):
+        used = [str(i + 1) for i in range(numFeatures) if isinstance(row['Feature' + str(i + 1)], str)
+                and row['Feature' + str(i + 1)] != '']
+        model = {key: value for key, value in row.items()
+                 if not re.fullmatch(r'(Feature|Coef)\d+|XtXInv_\d+_\d+', key)}
+        model['BestFeatures'] = [row['Feature' + n] for n in used]
+        model['Coefficients'] = [float(row['Coef' + n]) for n in used]
+        if ('XtXInv_0_0' in row):
+            indices = [0] + [int(n) for n in used]
+            model['XtXInv'] = np.array([[float(row['XtXInv_' + str(min(i, j)) + '_' + str(max(i, j))])
+                                         for j in indices] for i in indices])
+        models.append(model)
+    return models
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Functions to run the scripts in headless (batch) mode with the parameters read from a JSON
+# configuration file instead of being entered in the script. For example:
+#   python StockSOC_ExtractPoints.py extractConfig.json
+# The keys in the configuration file are the parameter names used in the script, e.g.
+#   {"startDate": "2022-01-01", "endDate": "2022-12-31", "CLOUD_PROBABILITY_THRESHOLD": 40,
+#    "boundaryShp": "/data/farm/boundary.shp", "inPoints": "/data/farm/points.shp",
+#    "outStore": "/data/farm/points", "SOC": "C%", "BD": "BD"}
+# Dates are entered as "YYYY-MM-DD". When a configuration file is used no maps are created.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+
+# Function to get the configuration file from the command line. Returns an empty string when
+# the script is run in a notebook or without a configuration file. A FileNotFoundError is
+# raised if the configuration file doesn't exist so a misspelled name isn't ignored.
+def commandLineConfig():
+    if (len(sys.argv) > 1 and sys.argv[1].lower().endswith('.json')):
+        if (not os.path.isfile(sys.argv[1])):
+            raise FileNotFoundError('Configuration file ' + sys.argv[1] + ' does not exist')
+        return sys.argv[1]
+    return ""
+
+
+# Function to replace the script parameters with the values in a configuration file. parameters
+# is the dictionary of script variables (globals()). Only existing parameters can be set so a
+# misspelled name raises an error instead of being silently ignored.
+def applyConfig(configFile, parameters):
+    with open(configFile, 'r') as f:
+        config = json.load(f)
+    unknown = [key for key in config if key not in parameters]
+    if (len(unknown) > 0):
+        raise ValueError("Unknown parameters in " + configFile + ": " + ", ".join(unknown))
+    for key, value in config.items():
+        if (isinstance(parameters[key], datetime) and isinstance(value, str)):
+            value = datetime.strptime(value, '%Y-%m-%d')
+        parameters[key] = value
+    return config
+
+
+# Function to create the process pool used to process dates or tiles at the same time. When a
+# script is run from the command line (headless mode) with the spawn or forkserver start method
+# each process imports the script again and runs all of its cells. On Linux the processes are
+# forked instead. Forking isn't safe on macOS (and isn't possible on Windows), so there None is
+# returned and the work is done in this process. In a notebook the default start method is used.
+def processPool(numWorkers=None):
+    if (numWorkers == 1):
+        return None
+    mainFile = getattr(sys.modules['__main__'], '__file__', None)
+    if (mainFile is None or multiprocessing.get_start_method() == 'fork'):
+        return ProcessPoolExecutor(max_workers=numWorkers)
+    if (sys.platform.startswith('linux')):
+        return ProcessPoolExecutor(max_workers=numWorkers, mp_context=multiprocessing.get_context('fork'))
+    print('Only one process is used when ' + os.path.basename(mainFile) + ' is run from the command '
+          'line on this system. Run it in a notebook to use more processes.')
+    return None
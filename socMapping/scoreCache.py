@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# A local cache for the subset scores calculated by "StockSOC_ProcessPoints". The scores for
+# each date are saved in a JSON file named with a hash of the date, the point data (features
+# and target values), the target variable and the cross validation scheme. Inside the file
+# each score is saved with the names of the features in the subset. When the script is run
+# again, for example after increasing max_feat, only the subsets that aren't in the file are
+# scored.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+
+# Function to get the cache file for one date. scheme describes how the scores are
+# calculated, for example 'kfold10' or 'loo'.
+def scoreCacheFile(cacheDir, date, x, y, featureNames, target, scheme):
+    keyHash = hashlib.sha256()
+    for part in (str(date), target, scheme, '|'.join(featureNames)):
+        keyHash.update(part.encode('utf-8') + b'\0')
+    keyHash.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    keyHash.update(np.ascontiguousarray(y, dtype=np.float64).tobytes())
+    return os.path.join(cacheDir, 'scores_' + keyHash.hexdigest() + '.json')
+
+
+# Function to read the cached scores from a cache file. Output is a dictionary with the
+# subset key (feature names separated by |) and the score.
+def readScores(cacheFile):
+    try:
+        with open(cacheFile, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Function to get the scores for a list of subsets (tuples of feature indices) using the
+# cache. scoreSubsets is the function that calculates the scores for a list of subsets and is
+# only called for the subsets that aren't in the cache file. New scores are added to the file.
+def cachedScores(cacheFile, subsets, featureNames, scoreSubsets):
+    cached = readScores(cacheFile)
+    keys = ['|'.join(featureNames[i] for i in s) for s in subsets]
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    if (len(missing) > 0):
+        newScores = scoreSubsets([subsets[i] for i in missing])
+        for i, score in zip(missing, newScores):
+            cached[keys[i]] = float(score)
+        # Write to a temporary file first so a stopped run never leaves a partial file
+        os.makedirs(os.path.dirname(cacheFile) or '.', exist_ok=True)
+        handle, tmpPath = tempfile.mkstemp(dir=os.path.dirname(cacheFile) or '.', suffix='.tmp')
+        with os.fdopen(handle, 'w') as f:
+            json.dump(cached, f)
+        os.replace(tmpPath, cacheFile)
+    return np.array([cached[key] for key in keys])
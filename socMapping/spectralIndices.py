@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Registry of the spectral indices used as features in the regression. Each index is defined
+# once as an expression string and the Sentinel-2 band used for each variable. The same
+# definitions are used to calculate the indices for the points in "StockSOC_ProcessPoints"
+# (with NumPy, all indices in one pass over a single array of band values) and to create the
+# index bands with ee.Image.expression in "stockSOC_PredictImage", so the two can't differ.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import numpy as np
+
+
+# Index name: (expression, {variable: band}). The expressions only use +, -, *, / and
+# parentheses so they are evaluated the same way by Python and Earth Engine.
+SPECTRAL_INDICES = {
+    # Normalized difference vegetation index
+    'ndvi': ('(nir - red)/(nir + red)', {'red': 'B4', 'nir': 'B8'}),
+    # Soil-adjusted total vegetation index
+    'satvi': ('((swir1 -red)/(swir1 + red+0.5)) * 1.5 - (swir2/2)',
+              {'red': 'B4', 'swir1': 'B11', 'swir2': 'B12'}),
+    # Normalized burn ratio 2
+    'nbr2': ('(swir1 -swir2)/(swir1 + swir2)', {'swir1': 'B11', 'swir2': 'B12'}),
+    # Soil organic carbon index
+    'soci': ('blue/(red * green)', {'blue': 'B2', 'green': 'B3', 'red': 'B4'}),
+    # Bare soil index
+    'bsi': ('(swir1 + red) -(nir + blue) / (swir1 + red) + (nir + blue)',
+            {'blue': 'B2', 'red': 'B4', 'nir': 'B8', 'swir1': 'B11'}),
+}
+
+# Compiled expressions so each one is only parsed once
+compiledIndices = {name: compile(expression, name, 'eval')
+                   for name, (expression, bandMap) in SPECTRAL_INDICES.items()}
+
+
+# Function to list the bands needed to calculate a list of indices (all indices if None)
+def indexBands(indexNames=None):
+    indexNames = list(SPECTRAL_INDICES) if indexNames is None else indexNames
+    bands = []
+    for name in indexNames:
+        for band in SPECTRAL_INDICES[name][1].values():
+            if (band not in bands):
+                bands.append(band)
+    return bands
+
+
+# Function to calculate indices from an array of band values (samples x bands, or bands x rows
+# x columns with bandAxis=0). bandNames are the names of the bands in the array. Output is an
+# array with one index for each column (or first axis with bandAxis=0) in the order of
+# indexNames. Division by zero gives inf or NaN like the DataFrame calculation did.
+def calcIndices(bandValues, bandNames, indexNames=None, dtype=np.float64, bandAxis=-1):
+    indexNames = list(SPECTRAL_INDICES) if indexNames is None else indexNames
+    bandValues = np.moveaxis(np.asarray(bandValues), bandAxis, 0)
+    bandValues = np.ascontiguousarray(bandValues, dtype=dtype)
+    output = np.empty((len(indexNames),) + bandValues.shape[1:], dtype=dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, name in enumerate(indexNames):
+            bandMap = SPECTRAL_INDICES[name][1]
+            variables = {var: bandValues[bandNames.index(band)] for var, band in bandMap.items()}
+            output[i] = eval(compiledIndices[name], {'__builtins__': {}}, variables)
+    return np.moveaxis(output, 0, bandAxis)
+
+
+# Function to add index columns to a table of points with the band values in columns
+def addIndexColumns(points, indexNames=None):
+    indexNames = list(SPECTRAL_INDICES) if indexNames is None else indexNames
+    bands = indexBands(indexNames)
+    indices = calcIndices(points[bands].to_numpy(dtype=np.float64), bands, indexNames)
+    points[indexNames] = indices
+    return points
+
+
+# Function to add index bands to an Earth Engine image with ee.Image.expression
+def addIndexBands(img, indexNames=None):
+    indexNames = list(SPECTRAL_INDICES) if indexNames is None else indexNames
+    for name in indexNames:
+        expression, bandMap = SPECTRAL_INDICES[name]
+        img = img.addBands(img.expression(expression, {var: img.select(band)
+                                                       for var, band in bandMap.items()}).rename(name))
+    return img
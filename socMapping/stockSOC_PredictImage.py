@@ -6,8 +6,8 @@
 
 # This script is used to predict SOC% or stock to create an output image based on linear 
 # regression model coefficients calculated from the previous (StockSOC_ProcessPoints) script. 
-# The output will be a 16-bit integer GeoTIFF image with pixel units of either SOC 
-# stock/hectare or SOC%/hectare. 
+# The output will be a float32 GeoTIFF image (16-bit integer if tiledExport is False) with pixel 
+# units of either SOC stock/hectare or SOC%/hectare. 
 
 # This script was written by Ned Horning [ned.horning@regen.network]
 
@@ -23,21 +23,26 @@ import geemap
 import json
 import os
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta
 from geemap import geojson_to_ee, ee_to_geojson
 import geopandas as gpd 
 import pandas as pd
 import pickle
 import math
-#ee.Authenticate()
-ee.Initialize()
+from eeCache import useCache, getInfo
+from runConfig import commandLineConfig, applyConfig
+from modelBands import modelImage, predictionExpression, predictImage, batchPredictionImages, \
+    datedFileName, standardErrorImage
+from localRaster import predictRaster, findScenes
+from resultsWriter import readModels
+from eeExport import exportTiled
 
 
 # In[3]:
 
 
 ### Enter Sentinel image date as numbers for year, month, day ###
-date = ee.Date.fromYMD(2021, 4, 15) # This is the date of the image you want to process  
+date = datetime(2021, 4, 15) # This is the date of the image you want to process  
 
 # Scale (resolution) in meters for the output image
 pixScale = 20
@@ -58,6 +63,29 @@ BUFFER = 50
 boundaryShp = "/home/nedhorning/RegenNetwork/Methodologies/ImpactAg/WilmotFarmLabTesting/Wilmot2023Boundary.shp"
 outImage = "/home/nedhorning/RegenNetwork/gee_notebooks/testGitHub/testImage.tif"
 
+# Directory to save Earth Engine results so they don't need to be requested again when the
+# script is run with the same settings. Leave empty to turn off the cache.
+cacheDir = ""
+
+# Where the prediction is calculated: 'gee' to use Google Earth Engine or 'local' to predict
+# from a Sentinel-2 scene and TWI and CHILI images saved as GeoTIFF files on a local disk. The
+# local prediction is written as a tiled, compressed float32 GeoTIFF one tile at a time so large
+# areas can be predicted. The scene should have clouds and shadows set to nodata.
+predictionBackend = 'gee'
+localScene = ""
+# Pattern for the local scene files used for batch prediction, with the date in each file name
+localScenes = ""
+# List of the band names in the scene file (None to use the band descriptions in the file)
+localBandNames = None
+localTWI = ""
+localCHILI = ""
+# Optional cloud optimized GeoTIFF copy of the local prediction
+outCOG = ""
+# Tile size in pixels and number of processes used for the local prediction (None to use all
+# processors)
+tileSize = 512
+numWorkers = None
+
 
 # In[5]:
 
@@ -67,30 +95,81 @@ intercept = 160.44103179
 coef = [-8.28360887e+01,  2.48191570e-02, -1.65602135e+02]
 bands = ['B12', 'B8', 'satvi']
 
+### To add a band with the standard error of the prediction for every pixel enter the X'X inverse
+### (intercept first) and the residual variance of the model (the XtXInv_i_j and Sigma2 columns in
+### the "StockSOC_ProcessPoints" results file). Leave as None for only the prediction. With batch
+### prediction the values are read from the results file when standardError is True.
+xtxInv = None
+sigma2 = None
+standardError = True
+
+### To predict images for the dates in the results CSV file from "StockSOC_ProcessPoints" instead
+### of the single model above, enter the file name. Only models with an R2 of at least minR2 and an
+### NRMSE no larger than maxNRMSE are used (None to use all). batchOutput is 'multiBand' for one
+### image with a band for each date or 'multiFile' for an image for each date (outImage with the
+### date added to the name). With the local backend there is always one image for each date.
+resultsCSV = ""
+minR2 = 0.5
+maxNRMSE = None
+batchOutput = 'multiBand'
+
 
 # In[ ]:
 
 
-### Multiply pixel values by this factor when converting to int16. 
+### Download the Earth Engine prediction as a grid of tiles that are combined into a single float32
+### image (see eeExport.py) so large areas can be downloaded. exportWorkers is the number of tiles
+### downloaded at the same time. Set tiledExport to False to download the whole area in one
+### request as an int16 image.
+tiledExport = True
+exportWorkers = 8
+
+### Multiply pixel values by this factor when converting to int16 (only used when tiledExport is False). 
 float_to_int16_factor = 10
 
 
+# In[ ]:
+
+
+# Headless (batch) mode: to run the script without a notebook enter the name of a JSON file
+# with the parameters to use on the command line, e.g. "python stockSOC_PredictImage.py config.json". 
+# Parameters in the file replace the values entered above and no maps are created.
+configFile = commandLineConfig()
+if (configFile):
+    applyConfig(configFile, globals())
+showMap = not configFile and predictionBackend == 'gee'
+
+
+# In[ ]:
+
+
+# Initialize Earth Engine (not needed when the prediction is calculated from local files)
+if (predictionBackend == 'gee'):
+    #ee.Authenticate()
+    ee.Initialize()
+# Save the results of Earth Engine requests in cacheDir so identical requests are only sent once
+if (cacheDir):
+    useCache(cacheDir)
+
+
 # In[6]:
 
 
 # Function to get image data and apply cloud/shadow filter
-def get_s2_sr_cld_col(aoi, start_date):
+def get_s2_sr_cld_col(aoi, start_date, end_date=None):
+    start_date = ee.Date(start_date)
+    end_date = start_date.advance(1, 'day') if end_date is None else ee.Date(end_date)
     # Import and filter S2 SR.
     s2_sr_col = (ee.ImageCollection('COPERNICUS/S2_SR')
         .filterBounds(aoi)
         #.filterMetadata('MGRS_TILE', 'equals', '14SKJ')  # Use this to specify a specific tile
-        .filterDate(start_date, start_date.advance(1, 'day'))
+        .filterDate(start_date, end_date)
         .filter(ee.Filter.lte('CLOUDY_PIXEL_PERCENTAGE', CLOUD_FILTER)))
 
     # Import and filter s2cloudless.
     s2_cloudless_col = (ee.ImageCollection('COPERNICUS/S2_CLOUD_PROBABILITY')
         .filterBounds(aoi)
-        .filterDate(start_date, start_date.advance(1, 'day')))
+        .filterDate(start_date, end_date))
 
     # Join the filtered s2cloudless collection to the SR collection by the 'system:index' property.
     return ee.ImageCollection(ee.Join.saveFirst('s2cloudless').apply(**{
@@ -187,7 +266,7 @@ def apply_cld_shdw_mask(img):
 
 # Function make the server-side feature collection accessible to the client
 def getValues(fc):
-    features = fc.getInfo()['features']
+    features = getInfo(fc)['features']
     dictarr = []
     for f in features:
         attr = f['properties']
@@ -195,26 +274,46 @@ def getValues(fc):
     return dictarr
 
 
+# In[ ]:
+
+
+# Read the models used for batch prediction
+models = []
+if (resultsCSV):
+    models = readModels(resultsCSV, minR2, maxNRMSE)
+    print(str(len(models)) + ' models selected from ' + resultsCSV)
+    if (len(models) == 0):
+        raise ValueError('No models in ' + resultsCSV + ' have an R2 of at least ' + str(minR2) +
+                         ' and an NRMSE no larger than ' + str(maxNRMSE))
+
+
 # In[12]:
 
 
-# Convert input boundary Shapefile to a GEE boundary feature to constrain spatial extent
-boundary_ee = geemap.shp_to_ee(boundaryShp)
+if (predictionBackend == 'gee'):
+    # Convert input boundary Shapefile to a GEE boundary feature to constrain spatial extent
+    boundary_ee = geemap.shp_to_ee(boundaryShp)
 
 
 # In[13]:
 
 
-# Get image data using temporal and spatial constraints
-s2_sr_cld_col = get_s2_sr_cld_col(boundary_ee, date)
+if (predictionBackend == 'gee' and resultsCSV):
+    # Get image data for all of the model dates with one collection
+    modelDates = sorted(datetime.strptime(model['Date'], '%Y_%m_%d') for model in models)
+    s2_sr_cld_col = get_s2_sr_cld_col(boundary_ee, modelDates[0], modelDates[-1] + timedelta(days=1))
+elif (predictionBackend == 'gee'):
+    # Get image data using temporal and spatial constraints
+    s2_sr_cld_col = get_s2_sr_cld_col(boundary_ee, date)
 
 
 # In[14]:
 
 
-# Apply cloud/shadow mask and add NDVI layer
-sentinelCollection = (s2_sr_cld_col.map(add_cld_shdw_mask)
-                             .map(apply_cld_shdw_mask))
+if (predictionBackend == 'gee'):
+    # Apply cloud/shadow mask and add NDVI layer
+    sentinelCollection = (s2_sr_cld_col.map(add_cld_shdw_mask)
+                                 .map(apply_cld_shdw_mask))
 
 
 # In[15]:
@@ -240,148 +339,144 @@ allPoints = {}
 # In[17]:
 
 
-# Calculate Topographic wetness index and extract points
-upslopeArea = (ee.Image("MERIT/Hydro/v1_0_1")
-    .select('upa'))
-elv = (ee.Image("MERIT/Hydro/v1_0_1")
-    .select('elv'))
+# Function to calculate the topographic wetness index. The covariates are only created if
+# they are used by the model.
+def calcTWI():
+    upslopeArea = (ee.Image("MERIT/Hydro/v1_0_1")
+        .select('upa'))
+    elv = (ee.Image("MERIT/Hydro/v1_0_1")
+        .select('elv'))
 
-slope = ee.Terrain.slope(elv)
-upslopeArea = upslopeArea.multiply(1000000).rename('UpslopeArea')
-slopeRad = slope.divide(180).multiply(math.pi)
-TWI = ee.Image.log(upslopeArea.divide(slopeRad.tan())).rename('twi')
+    slope = ee.Terrain.slope(elv)
+    upslopeArea = upslopeArea.multiply(1000000).rename('UpslopeArea')
+    slopeRad = slope.divide(180).multiply(math.pi)
+    return ee.Image.log(upslopeArea.divide(slopeRad.tan())).rename('twi')
 
 
 # In[18]:
 
 
-# Read in and extract points for continuous heat-insolation load index and extract points
-chili = (ee.Image("CSP/ERGo/1_0/Global/SRTM_CHILI"))
+# Function to read the continuous heat-insolation load index
+def calcCHILI():
+    return ee.Image("CSP/ERGo/1_0/Global/SRTM_CHILI")
 
 
 # In[19]:
 
 
-img = sentinelCollection.first().addBands(TWI).addBands(chili.rename('chili'))
+if (predictionBackend == 'gee' and not resultsCSV):
+    img = sentinelCollection.first()
 
 
 # In[20]:
 
 
-# Calculate NDVI
-ndvi = img.expression('(nir - red)/(nir + red)', {
-    'red' : img.select('B4'),
-    'nir' : img.select('B8')}).rename('ndvi')
-
-
-# In[21]:
-
-
-# Calculate SATVI
-satvi = img.expression('((swir1 -red)/(swir1 + red+0.5)) * 1.5 - (swir2/2)', {
-    'red' : img.select('B4'),
-    'swir1' : img.select('B11'),
-    'swir2' : img.select('B12')}).rename('satvi')
+if (predictionBackend == 'gee' and not resultsCSV):
+    # Build only the bands used by the model: the Sentinel-2 bands, the spectral indices defined
+    # in spectralIndices.py and the TWI and CHILI covariates that are in the bands list
+    finalImage = modelImage(img, bands, {'twi': calcTWI, 'chili': calcCHILI})
 
 
-# In[22]:
-
-
-# Calculate NBR2
-nbr2 = img.expression('(swir1 -swir2)/(swir1 + swir2)', {
-    'swir1' : img.select('B11'),
-    'swir2' : img.select('B12')}).rename('nbr2')
-
-
-# In[23]:
-
+# In[26]:
 
-# Calculate SOCI
-soci = img.expression('blue/(red * green)', {
-    'blue' : img.select('B2'),
-    'green' : img.select('B3'),
-    'red' : img.select('B4')}).rename('soci')
 
+if (predictionBackend == 'gee' and not resultsCSV):
+    # Create the prediction for any number of coefficients
+    print('Prediction equation: ' + predictionExpression(intercept, coef))
+    predImage = predictImage(finalImage, intercept, coef, bands)
+    # The image that is downloaded has the prediction and the standard error (if there is a
+    # covariance matrix), calculated from the same bands
+    exportImage = predImage
+    if (xtxInv is not None):
+        exportImage = predImage.addBands(standardErrorImage(finalImage, xtxInv, sigma2, bands))
 
-# In[24]:
 
+# In[27]:
 
-# Calculate BSI
-bsi = img.expression('(swir1 + red) -(nir + blue) / (swir1 + red) + (nir + blue)', {
-    'blue' : img.select('B2'),
-    'red' : img.select('B4'),
-    'nir' : img.select('B8'),
-    'swir1' : img.select('B11')}).rename('bsi')
 
+Map = None
+if (showMap and not resultsCSV):
+    Map=geemap.Map()
+    Map.centerObject(boundary_ee, 13)
+    Map.addLayer(predImage, predViz, 'pred')
+    Map.addLayer(boundary_ee, {}, "Boundary EE")
+Map
 
-# In[25]:
 
+# In[28]:
 
-# Combine all bands into a single image
-finalImage = img.addBands(ndvi).addBands(satvi).addBands(nbr2).addBands(soci).addBands(bsi)
 
+if (showMap and not resultsCSV):
+    Map=geemap.Map()
+    Map.centerObject(boundary_ee, 13)
+    Map.addLayer(img, sentinel_vis, "image")
+    Map.addLayer(boundary_ee, {}, "Boundary EE")
+Map
 
-# In[26]:
 
+# In[29]:
 
-# Select the regression prediction algoritm bases on number of coefficients
-if len(coef) == 2 :
-    exp = str(intercept) + ' + (' + str(coef[0]) + ' * b1)' + ' + (' + str(coef[1]) + ' * b2)'
-    print('Prediction equation: ' + exp)
-    predImage = finalImage.expression(exp, {
-            'b1' : finalImage.select(bands[0]),
-            'b3' : finalImage.select(bands[1])})
-elif len(coef) == 3 :
-    exp = str(intercept) + ' + (' + str(coef[0]) + ' * b1)' + ' + (' + str(coef[1]) + ' * b2)' + \
-    ' + (' + str(coef[2]) + ' * b3)'
-    print('Prediction equation: ' + exp)
-    predImage = finalImage.expression(exp, {
-            'b1' : finalImage.select(bands[0]),
-            'b2' : finalImage.select(bands[1]),
-            'b3' : finalImage.select(bands[2])})
-elif len(coef) == 4 :
-    exp = str(intercept) + ' + (' + str(coef[0]) + ' * b1)' + ' + (' + str(coef[1]) + ' * b2)' + \
-    ' + (' + str(coef[2]) + ' * b3)' + ' + (' + str(coef[3]) + ' * b4)' 
-    print('Prediction equation: ' + exp)
-    predImage = finalImage.expression(exp, {
-            'b1' : finalImage.select(bands[0]),
-            'b2' : finalImage.select(bands[1]),
-            'b3' : finalImage.select(bands[2]),
-            'b4' : finalImage.select(bands[3])})
-else:
-    print("The number of regression coeficients must be between 2 and 4")
 
+if (predictionBackend == 'gee' and not tiledExport and not resultsCSV):
+    # Multiply the output image by a factor to be able to convert to integer allowing larger areas to be downloaded
+    outputImage = exportImage.multiply(float_to_int16_factor).round().toInt16()
 
-# In[27]:
 
+# In[30]:
 
-Map=geemap.Map()
-Map.centerObject(boundary_ee, 13)
-Map.addLayer(predImage, predViz, 'pred')
-Map.addLayer(boundary_ee, {}, "Boundary EE")
-Map
 
+if (predictionBackend == 'gee' and tiledExport and not resultsCSV):
+    # Download the prediction in tiles and combine them into one float32 image
+    exportTiled(exportImage, outImage, boundary_ee.geometry(), pixScale, exportWorkers)
+elif (predictionBackend == 'gee' and not resultsCSV):
+    geemap.ee_export_image(outputImage, filename=outImage, scale=pixScale, region=boundary_ee.geometry(), \
+        file_per_band=True)
 
-# In[28]:
 
+# In[ ]:
 
-Map=geemap.Map()
-Map.centerObject(boundary_ee, 13)
-Map.addLayer(finalImage, sentinel_vis, "image")
-Map.addLayer(boundary_ee, {}, "Boundary EE")
-Map
 
+# Predict every pixel of the local scene inside the extent of the boundary. The prediction (and
+# the standard error if xtxInv is entered) is written as float32 values so it doesn't need to be
+# converted to int16.
+if (predictionBackend == 'local' and not resultsCSV):
+    predictRaster(localScene, outImage, intercept, coef, bands, {'twi': localTWI, 'chili': localCHILI},
+                  localBandNames, gpd.read_file(boundaryShp), tileSize, numWorkers, outCOG, xtxInv, sigma2)
 
-# In[29]:
 
+# In[ ]:
 
-# Multiply the output image by a factor to be able to convert to integer allowing larger areas to be downloaded
-outputImage = predImage.multiply(float_to_int16_factor).round().toInt16()
 
+# Predict all of the dates in the results file. The Earth Engine predictions share one masked
+# image collection and one set of TWI and CHILI covariates.
+if (predictionBackend == 'gee' and resultsCSV):
+    predictions = batchPredictionImages(sentinelCollection, models, {'twi': calcTWI, 'chili': calcCHILI},
+                                        standardError)
+    if (len(predictions) == 0):
+        print('None of the model dates have an image in the collection so nothing was predicted')
+    elif (batchOutput == 'multiBand'):
+        exportTiled(ee.Image.cat(list(predictions.values())), outImage, boundary_ee.geometry(), pixScale,
+                    exportWorkers)
+    else:
+        for modelDate, prediction in predictions.items():
+            print('Downloading the prediction for ' + modelDate)
+            exportTiled(prediction, datedFileName(outImage, modelDate), boundary_ee.geometry(), 
+                        pixScale, exportWorkers)
 
-# In[30]:
 
+# In[ ]:
 
-geemap.ee_export_image(outputImage, filename=outImage, scale=pixScale, region=boundary_ee.geometry(), \
-    file_per_band=True)
 
+# Predict the dates in the results file from the local scenes with the same date
+if (predictionBackend == 'local' and resultsCSV):
+    localBoundary = gpd.read_file(boundaryShp)
+    scenePaths = {sceneDate: path for sceneDate, imageID, path in findScenes(localScenes)}
+    for model in models:
+        if (model['Date'] not in scenePaths):
+            print('No local scene for ' + model['Date'])
+            continue
+        print('Predicting ' + model['Date'])
+        predictRaster(scenePaths[model['Date']], datedFileName(outImage, model['Date']), model['Intercept'],
+                      model['Coefficients'], model['BestFeatures'], {'twi': localTWI, 'chili': localCHILI},
+                      localBandNames, localBoundary, tileSize, numWorkers,
+                      xtxInv=model.get('XtXInv') if standardError else None, sigma2=model.get('Sigma2'))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Functions used by the "StockSOC_ProcessPoints" script to find the subset of features
+# (variables) that gives the best linear regression. Instead of fitting a new regression for
+# every subset and cross validation fold, the Gram matrix (X'X and X'y) is calculated once
+# for each date. The regression for each subset and fold is then solved from the rows and
+# columns of the Gram matrix for that subset, with all subsets with the same number of
+# features solved together using NumPy.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import itertools
+import numpy as np
+
+
+# Maximum number of subsets solved at the same time, to limit memory use
+SUBSET_CHUNK = 10000
+
+
+# Function to calcualte adjusted R2
+def adjust_r2(r2, num_examples, num_features):
+    coef = (num_examples - 1) / (num_examples - num_features - 1)
+    return 1 - (1 - r2) * coef
+
+
+# Function to list all subsets of feature indices with between minFeat and maxFeat features
+def featureSubsets(numFeatures, minFeat, maxFeat):
+    subsets = []
+    for k in range(minFeat, min(maxFeat, numFeatures) + 1):
+        subsets.extend(itertools.combinations(range(numFeatures), k))
+    return subsets
+
+
+# Function to split the sample indices into the same consecutive folds used by the
+# scikit-learn KFold cross validation (without shuffling)
+def kFolds(numSamples, numFolds):
+    return np.array_split(np.arange(numSamples), numFolds)
+
+
+# Function to create the design matrix: a column of ones for the intercept followed by the
+# features centered and scaled to unit variance. Scaling doesn't change the predictions but
+# keeps the Gram matrix well conditioned when bands and indices have very different ranges.
+def designMatrix(x):
+    x = np.asarray(x, dtype=float)
+    scale = x.std(axis=0)
+    scale[scale == 0] = 1
+    return np.hstack([np.ones((x.shape[0], 1)), (x - x.mean(axis=0)) / scale])
+
+
+# Function to solve a stack of normal equations G b = c. If any of the systems is singular
+# (for example two identical features) the pseudo-inverse is used, which gives the same
+# minimum norm solution as a least squares fit.
+def solveNormal(G, c):
+    try:
+        return np.linalg.solve(G, c[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return (np.linalg.pinv(G) @ c[..., None])[..., 0]
+
+
+# Function to get the design matrix column indices (intercept first) for a group of subsets
+# with the same number of features
+def subsetColumns(subsets):
+    return np.array([(0,) + tuple(i + 1 for i in s) for s in subsets], dtype=np.intp)
+
+
+# Function to calculate R2 the same way as scikit-learn r2_score. ssRes has one value for
+# each subset.
+def r2Score(ssRes, ssTot):
+    if (ssTot == 0):
+        return np.where(ssRes == 0, 1.0, 0.0)
+    return 1 - ssRes / ssTot
+
+
+# Function to calculate the average cross validated R2 for each subset of features, the same
+# score calculated by the mlxtend ExhaustiveFeatureSelector with scoring='r2' and cv=numFolds.
+# For each fold the training Gram matrix is the full Gram matrix minus the Gram matrix of the
+# samples in the fold so the data are only read once.
+def cvScores(x, y, subsets, numFolds):
+    X = designMatrix(x)
+    y = np.asarray(y, dtype=float).ravel()
+    G = X.T @ X
+    c = X.T @ y
+    folds = [(X[f], y[f], f) for f in kFolds(len(y), numFolds)]
+    foldGram = [(G - Xf.T @ Xf, c - Xf.T @ yf) for Xf, yf, f in folds]
+
+    scores = np.zeros(len(subsets))
+    sizes = np.array([len(s) for s in subsets])
+    for k in np.unique(sizes):
+        groupIndex = np.flatnonzero(sizes == k)
+        for start in range(0, len(groupIndex), SUBSET_CHUNK):
+            chunk = groupIndex[start:start + SUBSET_CHUNK]
+            cols = subsetColumns([subsets[i] for i in chunk])
+            total = np.zeros(len(chunk))
+            for (Xf, yf, f), (Gtrain, cTrain) in zip(folds, foldGram):
+                beta = solveNormal(Gtrain[cols[:, :, None], cols[:, None, :]], cTrain[cols])
+                predicted = np.einsum('nmj,mj->mn', Xf[:, cols], beta)
+                ssRes = ((yf[None, :] - predicted) ** 2).sum(axis=1)
+                total += r2Score(ssRes, ((yf - yf.mean()) ** 2).sum())
+            scores[chunk] = total / len(folds)
+    return scores
+
+
+# Function to select the subset with the highest score. When scores are equal the subset with
+# fewer features is selected.
+def selectBest(subsets, scores):
+    order = sorted(range(len(subsets)), key=lambda i: (-scores[i], len(subsets[i]), i))
+    return order[0]
+
+
+# Function to find the subset of features with the highest adjusted cross validated R2. x is
+# the array of features (samples x features) and y the values to predict. Output is the index
+# of the best subset and a dictionary with the subsets and their scores.
+def bestSubset(x, y, minFeat, maxFeat, numFolds):
+    numSamples, numFeatures = np.shape(x)
+    subsets = featureSubsets(numFeatures, minFeat, maxFeat)
+    avgScores = cvScores(x, y, subsets, numFolds)
+    adjustedScores = np.array([adjust_r2(avgScores[i], numSamples, len(s))
+                               for i, s in enumerate(subsets)])
+    best = selectBest(subsets, adjustedScores)
+    return subsets[best], {'subsets': subsets, 'avg_score': avgScores,
+                           'adjusted_avg_score': adjustedScores}
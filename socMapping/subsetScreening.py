@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Two-stage subset selection. Most subsets of features are clearly poor, so instead of cross
+# validating every subset, the subsets are first ranked by a score that only needs one fit on
+# all of the samples (in-sample adjusted R2, AIC or BIC, calculated from the residual sum of
+# squares). Only the top k subsets are then scored with the cross validation used in
+# "subsetRegression.py" or "looMetrics.py". The screening can be audited by also running the
+# full evaluation and checking if the selected subset changes.
+
+# This script is free software; you can redistribute it and/or modify it under the
+# terms of the Apache License 2.0 License.
+
+
+import numpy as np
+from subsetRegression import (adjust_r2, cvScores, designMatrix, featureSubsets, selectBest,
+                              solveNormal, subsetColumns, SUBSET_CHUNK)
+from looMetrics import looSubsetScores
+from leapsAndBounds import criterionScore, leapsAndBounds
+from scoreCache import cachedScores
+
+
+# Function to calculate the in-sample residual sum of squares for each subset of features.
+# All subsets with the same number of features are solved together from the Gram matrix.
+def subsetRSSAll(x, y, subsets):
+    X = designMatrix(x)
+    y = np.asarray(y, dtype=float).ravel()
+    G = X.T @ X
+    c = X.T @ y
+
+    rss = np.zeros(len(subsets))
+    sizes = np.array([len(s) for s in subsets])
+    for k in np.unique(sizes):
+        groupIndex = np.flatnonzero(sizes == k)
+        for start in range(0, len(groupIndex), SUBSET_CHUNK):
+            chunk = groupIndex[start:start + SUBSET_CHUNK]
+            cols = subsetColumns([subsets[i] for i in chunk])
+            beta = solveNormal(G[cols[:, :, None], cols[:, None, :]], c[cols])
+            # RSS = y'y - b'X'y for the least squares solution b
+            rss[chunk] = np.maximum(y @ y - np.einsum('mj,mj->m', c[cols], beta), 0)
+    return rss
+
+
+# Function to select the topK subsets with the best in-sample criterion ('adjr2', 'aic' or
+# 'bic'). If useBnB is True the candidates are found with the branch-and-bound search
+# (leapsAndBounds.py) instead of fitting every subset. Output is the list of subsets kept, in
+# the same order as featureSubsets so ties are broken the same way as the full evaluation.
+def screenSubsets(x, y, minFeat, maxFeat, topK, criterion='adjr2', useBnB=False):
+    y = np.asarray(y, dtype=float).ravel()
+    ssTot = ((y - y.mean()) ** 2).sum()
+    if (useBnB):
+        bestBySize = leapsAndBounds(x, y, minFeat, maxFeat, nBest=topK)
+        candidates = [subset for k in sorted(bestBySize) for rss, subset in bestBySize[k]]
+        rss = np.array([rss for k in sorted(bestBySize) for rss, subset in bestBySize[k]])
+    else:
+        candidates = featureSubsets(np.shape(x)[1], minFeat, maxFeat)
+        rss = subsetRSSAll(x, y, candidates)
+    sizes = np.array([len(s) for s in candidates])
+    scores = criterionScore(rss, sizes, len(y), ssTot, criterion)
+    keep = sorted(np.argsort(-scores, kind='stable')[:topK],
+                  key=lambda i: (len(candidates[i]), candidates[i]))
+    return [candidates[i] for i in keep]
+
+
+# Function to score subsets with the selection criterion used by "StockSOC_ProcessPoints":
+# 'cv' for the adjusted k-fold cross validated R2 or 'loo' for the leave-one-out predicted R2.
+# If cacheFile is given the scores are read from and saved to the score cache (scoreCache.py).
+def selectionScores(x, y, subsets, selectionCriterion, numFolds, cacheFile=None, featureNames=None):
+    def scoreSubsets(subsetList):
+        if (selectionCriterion == 'loo'):
+            return looSubsetScores(x, y, subsetList)
+        return cvScores(x, y, subsetList, numFolds)
+
+    if (cacheFile):
+        scores = cachedScores(cacheFile, subsets, featureNames, scoreSubsets)
+    else:
+        scores = scoreSubsets(subsets)
+    if (selectionCriterion == 'loo'):
+        return scores
+    return np.array([adjust_r2(scores[i], len(y), len(s)) for i, s in enumerate(subsets)])
+
+
+# Function to find the best subset of features by screening with the in-sample criterion and
+# cross validating the topK subsets. Output is the same as subsetRegression.bestSubset, with
+# the screening scores of the subsets that were kept.
+def bestSubsetScreened(x, y, minFeat, maxFeat, numFolds, topK, screenCriterion='adjr2',
+                       selectionCriterion='cv', useBnB=False, cacheFile=None, featureNames=None):
+    subsets = screenSubsets(x, y, minFeat, maxFeat, topK, screenCriterion, useBnB)
+    scores = selectionScores(x, y, subsets, selectionCriterion, numFolds, cacheFile, featureNames)
+    return subsets[selectBest(subsets, scores)], {'subsets': subsets, 'score': scores}